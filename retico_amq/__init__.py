@@ -1,3 +1,6 @@
 from retico_amq.amq import *
+from retico_amq.metrics import *
+from retico_amq.profiling import *
+from retico_amq.request_reply import *
 
 __version__ = "0.1.0"
@@ -16,12 +16,641 @@ from retico_core.abstract import *
 
 # activemq & supporting libraries
 import json
+import multiprocessing
+import sys
 import threading
 import datetime
+import itertools
 import stomp
 import time
-from collections import deque
+import uuid
+from collections import deque, OrderedDict
+from types import MappingProxyType
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from retico_core.log_utils import log_exception
+from retico_amq.batching import AdaptiveBatchController
+from retico_amq.lanes import LaneIndex
+from retico_amq.metrics import AMQMetrics
+from retico_amq.profiling import StageProfiler
+from retico_amq.rate_limit import RateLimiter
+from retico_amq.shm import SharedMemoryReader, SharedMemoryRing, parse_shm_handle
+
+# priority lanes, from the most urgent to the least urgent one
+PRIORITY_CONTROL = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
+# value of the STOMP `priority` header (JMSPriority, 0-9) sent for each lane
+STOMP_PRIORITIES = ("9", "4", "0")
+
+
+def stomp_priority_to_lane(priority):
+    """Maps a STOMP `priority` header value (0-9) back to a priority lane.
+
+    Args:
+        priority (str): the value of the `priority` header.
+
+    Returns:
+        int: the corresponding lane, `PRIORITY_DEFAULT` if the value is not parsable.
+    """
+    try:
+        priority = int(priority)
+    except (TypeError, ValueError):
+        return PRIORITY_DEFAULT
+    if priority >= 7:
+        return PRIORITY_CONTROL
+    if priority >= 4:
+        return PRIORITY_DEFAULT
+    return PRIORITY_BULK
+
+
+def message_iuids(headers):
+    """Returns the iuids of the IUs sent in a message (`amq-iuid` header, comma-separated for an envelope or a batch).
+
+    Args:
+        headers (dict): the headers of the message.
+    """
+    iuids = headers.get("amq-iuid")
+    return set(iuids.split(",")) if iuids else set()
+
+
+class PriorityLanes:
+    """Thread-safe multi-lane FIFO queue. `get` always serves the most urgent non-empty lane (lane 0 first), except
+    when the oldest item of a less urgent lane has been waiting for more than `starvation_timeout` seconds, in which case
+    that item is served first so that bulk lanes are never starved.
+    Latency statistics (time between `append` and `get`) are kept for each lane, and the waiting items are counted per
+    ordering key (e.g. iuid), to find the lane of the waiting items with the same keys as a new one.
+    """
+
+    def __init__(self, nb_lanes=len(STOMP_PRIORITIES), starvation_timeout=0.5):
+        """Initializes the PriorityLanes.
+
+        Args:
+            nb_lanes (int): the number of lanes.
+            starvation_timeout (float): maximum time in seconds an item can wait while more urgent lanes are served.
+        """
+        # (enqueue time, item, ordering keys) of each lane
+        self.lanes = [deque() for _ in range(nb_lanes)]
+        self.index = LaneIndex()
+        self.starvation_timeout = starvation_timeout
+        self.cond = threading.Condition()
+        self.stats = [
+            {"count": 0, "total_latency": 0.0, "max_latency": 0.0, "starved": 0}
+            for _ in range(nb_lanes)
+        ]
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def depths(self):
+        """Returns the number of items waiting in each lane."""
+        return [len(lane) for lane in self.lanes]
+
+    def append(self, item, lane=PRIORITY_DEFAULT, keys=()):
+        """Adds an item at the end of a lane.
+
+        Args:
+            item (object): the item to queue.
+            lane (int): the lane to put the item in, clipped to the existing lanes.
+            keys (Collection): the distinct ordering keys of the item, looked up by `last_lane`.
+        """
+        lane = min(max(lane, 0), len(self.lanes) - 1)
+        with self.cond:
+            self.lanes[lane].append((time.monotonic(), item, keys))
+            self.index.add(keys, lane)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Removes and returns the next item to process, waiting up to `timeout` seconds for one to be available.
+
+        Args:
+            timeout (float): maximum time to wait, None waits forever.
+
+        Returns:
+            object: the next item, or None if the queue stayed empty.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self) > 0, timeout=timeout):
+                return None
+            now = time.monotonic()
+            served = None
+            for i, lane in enumerate(self.lanes):
+                if len(lane) == 0:
+                    continue
+                if served is None:
+                    served = i
+                elif now - lane[0][0] > self.starvation_timeout:
+                    served = i
+                    self.stats[i]["starved"] += 1
+                    break
+            enqueued_at, item, keys = self.lanes[served].popleft()
+            self.index.remove(keys, served)
+        self._record(served, now - enqueued_at)
+        return item
+
+    def pop_matching(self, lane, predicate, timeout=0):
+        """Removes and returns the first item of a lane matching a predicate, waiting up to `timeout` seconds for one
+        to be available. The wait stops as soon as an item is added to a more urgent lane.
+
+        Args:
+            lane (int): the lane to look in.
+            predicate (Callable[[object], bool]): function selecting the item.
+            timeout (float): maximum time to wait.
+
+        Returns:
+            object: the item, or None if no matching item was found.
+        """
+
+        def find():
+            for i, (_, item, _) in enumerate(self.lanes[lane]):
+                if predicate(item):
+                    return i
+            return None
+
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            index = find()
+            while index is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or any(len(l) > 0 for l in self.lanes[:lane]):
+                    return None
+                self.cond.wait(remaining)
+                index = find()
+            enqueued_at, item, keys = self.lanes[lane][index]
+            del self.lanes[lane][index]
+            self.index.remove(keys, lane)
+        self._record(lane, time.monotonic() - enqueued_at)
+        return item
+
+    def last_lane(self, keys, lane=0):
+        """Returns the least urgent lane after `lane` holding an item with one of the ordering keys, None if there is
+        none.
+
+        Args:
+            keys (Iterable): the ordering keys to look for.
+            lane (int): the lane the search stops at, excluded.
+        """
+        with self.cond:
+            return self.index.last_lane(keys, lane)
+
+    def _record(self, lane, latency):
+        stats = self.stats[lane]
+        stats["count"] += 1
+        stats["total_latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+
+    def lane_stats(self):
+        """Returns per-lane statistics : number of items served, mean and max latency in seconds, number of items
+        served because of starvation protection, and current depth.
+        """
+        return [
+            {
+                "lane": i,
+                "depth": len(self.lanes[i]),
+                "count": stats["count"],
+                "mean_latency": (
+                    stats["total_latency"] / stats["count"] if stats["count"] else 0.0
+                ),
+                "max_latency": stats["max_latency"],
+                "starved": stats["starved"],
+            }
+            for i, stats in enumerate(self.stats)
+        ]
+
+
+def match_priority_rules(rules, destination, *args):
+    """Returns the lane of the first rule matching the destination (and predicate), None if no rule matches.
+
+    Args:
+        rules (list): list of (lane, destination, predicate) tuples, destination or predicate can be None.
+        destination (str): the ActiveMQ destination.
+        args: arguments given to the rules' predicates.
+    """
+    for lane, rule_destination, predicate in rules:
+        if rule_destination is not None and rule_destination != destination:
+            continue
+        if predicate is not None and not predicate(*args):
+            continue
+        return lane
+    return None
+
+
+class QoSProfile:
+    """Quality of service of the messages sent to an ActiveMQ destination.
+
+    Attributes:
+        - persistent (bool) : whether ActiveMQ stores the messages in its journal before delivering them.
+        - ttl (float) : time to live of the messages in seconds (sent as the STOMP `expires` header), None for no
+            expiration. Expired messages are discarded by ActiveMQ and by AMQReader.
+    """
+
+    def __init__(self, persistent=True, ttl=None):
+        self.persistent = persistent
+        self.ttl = ttl
+
+    def headers(self):
+        """Returns the STOMP headers corresponding to the profile, for a message sent now."""
+        headers = {"persistent": "true" if self.persistent else "false"}
+        if self.ttl is not None:
+            headers["expires"] = str(int((time.time() + self.ttl) * 1000))
+        return headers
+
+
+# named QoS profiles that can be attached to a destination or an AMQBridge
+QOS_PROFILES = {
+    # fire-and-forget real-time streams (audio frames, gaze updates, ...)
+    "realtime": QoSProfile(persistent=False, ttl=1.0),
+    # dialogue-state messages that must survive a broker restart
+    "state": QoSProfile(persistent=True),
+}
+
+
+def get_qos_profile(qos):
+    """Returns the QoSProfile corresponding to a profile or a profile name.
+
+    Args:
+        qos (str or QoSProfile): a QoSProfile, or the name of a profile from `QOS_PROFILES`.
+    """
+    if qos is None or isinstance(qos, QoSProfile):
+        return qos
+    if qos not in QOS_PROFILES:
+        raise ValueError(
+            f"unknown QoS profile {qos}, known profiles : {list(QOS_PROFILES)}"
+        )
+    return QOS_PROFILES[qos]
+
+
+def is_expired(frame):
+    """Returns True if the STOMP `expires` header of a received message is in the past.
+
+    Args:
+        frame (stomp.frame): the received ActiveMQ message.
+    """
+    expires = frame.headers.get("expires")
+    if expires is None:
+        return False
+    try:
+        expires = int(expires)
+    except ValueError:
+        return False
+    # 0 means that the message never expires
+    return expires != 0 and expires < time.time() * 1000
+
+
+# `update_type` header -> UpdateType : the values sent by AMQWriter, and the legacy `UpdateType.<NAME>` values
+UPDATE_TYPES = {
+    **{ut.value: ut for ut in retico_core.UpdateType},
+    **{f"UpdateType.{ut.name}": ut for ut in retico_core.UpdateType},
+}
+# the update types that refer to an IU received before, without changing it (an UPDATE carries the IU's new body)
+HEADER_ONLY_UPDATE_TYPES = (
+    retico_core.UpdateType.REVOKE,
+    retico_core.UpdateType.COMMIT,
+)
+
+
+class SequenceTracker:
+    """Orders the messages received from each producer, using the `amq-producer` and `amq-seq` headers stamped by
+    AMQWriter, and suppresses the duplicated messages (e.g. redelivered after a failover).
+    Each stream (producer, destination, priority) has its own sequence. A message arriving ahead of its stream's next
+    expected sequence number is kept in a reorder buffer until the missing messages arrive, or until it has waited for
+    more than `reorder_timeout` seconds (or the buffer is full), in which case the missing messages are counted as a gap
+    and skipped.
+    Messages without sequence headers are delivered immediately, and deduplicated using their `message-id` header.
+    The messages of a message group (`JMSXGroupID` header) have their own stream. Only the `max_streams` most recently
+    used streams are remembered, the waiting messages of a forgotten stream being delivered.
+    """
+
+    def __init__(
+        self,
+        reorder_timeout=0.05,
+        reorder_size=64,
+        dedup_window=1024,
+        grouped_only=False,
+        max_streams=256,
+    ):
+        """Initializes the SequenceTracker.
+
+        Args:
+            reorder_timeout (float): maximum time in seconds a message can wait for the missing messages of its stream.
+            reorder_size (int): maximum number of messages kept in the reorder buffer of a stream.
+            dedup_window (int): number of `message-id` remembered to suppress duplicates of unsequenced messages.
+            grouped_only (bool): True to only sequence the messages of a message group, e.g. for a competing consumer,
+                that receives all the messages of its groups, but only part of the other streams.
+            max_streams (int): maximum number of streams remembered.
+        """
+        self.reorder_timeout = reorder_timeout
+        self.reorder_size = reorder_size
+        self.dedup_window = dedup_window
+        self.grouped_only = grouped_only
+        self.max_streams = max_streams
+        # stream -> next expected sequence number, least recently used first
+        self.expected = OrderedDict()
+        # stream -> {sequence number : (arrival time, frame)}, only for the streams with waiting messages
+        self.pending = dict()
+        self.message_ids = OrderedDict()
+        self.nb_duplicates = 0
+        self.nb_gaps = 0
+        self.nb_reordered = 0
+
+    @staticmethod
+    def stream(frame):
+        """Returns the stream of a message : its producer, destination, priority, message group, and the producer's id
+        of the stream (`amq-stream` header, renewed when the producer forgets and restarts the stream).
+        """
+        return (
+            frame.headers.get("amq-producer"),
+            frame.headers.get("destination"),
+            frame.headers.get("priority"),
+            frame.headers.get("JMSXGroupID"),
+            frame.headers.get("amq-stream"),
+        )
+
+    def push(self, frame):
+        """Adds a received message, and returns the list of messages that can be processed, in order.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+        """
+        if self.grouped_only and "JMSXGroupID" not in frame.headers:
+            return self._push_unsequenced(frame)
+        try:
+            seq = int(frame.headers["amq-seq"])
+        except (KeyError, ValueError):
+            return self._push_unsequenced(frame)
+        stream = self.stream(frame)
+        frames = []
+        expected = self.expected.get(stream)
+        if expected is None:
+            expected = self.expected[stream] = seq
+            frames.extend(self._evict())
+        else:
+            self.expected.move_to_end(stream)
+        pending = self.pending.get(stream, ())
+        if seq < expected or seq in pending:
+            self.nb_duplicates += 1
+            return frames
+        if seq > expected:
+            self.nb_reordered += 1
+            self.pending.setdefault(stream, dict())[seq] = (time.monotonic(), frame)
+            if len(self.pending[stream]) > self.reorder_size:
+                frames.extend(self._skip_gap(stream))
+            return frames
+        self.expected[stream] = seq + 1
+        frames.append(frame)
+        if pending:
+            frames.extend(self._release(stream))
+        return frames
+
+    def flush(self):
+        """Returns the messages that have waited for more than `reorder_timeout` seconds, skipping the missing
+        messages before them.
+        """
+        frames = []
+        now = time.monotonic()
+        for stream, pending in list(self.pending.items()):
+            if now - min(t for t, _ in pending.values()) > self.reorder_timeout:
+                frames.extend(self._skip_gap(stream))
+        return frames
+
+    def stats(self):
+        """Returns the number of duplicated, reordered and missing (gaps) messages."""
+        return {
+            "duplicates": self.nb_duplicates,
+            "reordered": self.nb_reordered,
+            "gaps": self.nb_gaps,
+            "pending": sum(len(pending) for pending in self.pending.values()),
+        }
+
+    def _push_unsequenced(self, frame):
+        message_id = frame.headers.get("message-id")
+        if message_id is None:
+            return [frame]
+        if message_id in self.message_ids:
+            self.nb_duplicates += 1
+            return []
+        self.message_ids[message_id] = None
+        if len(self.message_ids) > self.dedup_window:
+            self.message_ids.popitem(last=False)
+        return [frame]
+
+    def _skip_gap(self, stream):
+        first = min(self.pending[stream])
+        self.nb_gaps += first - self.expected[stream]
+        self.expected[stream] = first
+        return self._release(stream)
+
+    def _release(self, stream):
+        frames = []
+        pending = self.pending[stream]
+        expected = self.expected[stream]
+        while expected in pending:
+            frames.append(pending.pop(expected)[1])
+            expected += 1
+        self.expected[stream] = expected
+        if not pending:
+            del self.pending[stream]
+        return frames
+
+    def _evict(self):
+        """Forgets the least recently used streams above `max_streams`, and returns their waiting messages."""
+        frames = []
+        while len(self.expected) > self.max_streams:
+            stream, expected = self.expected.popitem(last=False)
+            pending = self.pending.pop(stream, None)
+            if pending:
+                self.nb_gaps += max(pending) - expected + 1 - len(pending)
+                frames.extend(pending[seq][1] for seq in sorted(pending))
+        return frames
+
+
+class IUIndex:
+    """Bounded LRU index of the IUs recently created by AMQReader, used to resolve the `previous_iu` and `grounded_in`
+    references (iuids of the producer's IUs, sent by AMQWriter) back into IUs.
+    Each destination has its own index of at most `size` IUs, the least recently used IUs being forgotten first.
+    """
+
+    def __init__(self, size=256):
+        """Initializes the IUIndex.
+
+        Args:
+            size (int): maximum number of IUs kept per destination.
+        """
+        self.size = size
+        # destination -> OrderedDict(producer's iuid -> IU)
+        self.indexes = dict()
+
+    def __len__(self):
+        return sum(len(index) for index in self.indexes.values())
+
+    def add(self, destination, iuid, iu):
+        """Indexes an IU created from a message received on `destination`.
+
+        Args:
+            destination (str): the ActiveMQ destination of the message.
+            iuid (str): the iuid of the IU on the producer's side (`requestID`).
+            iu (IncrementalUnit): the IU created by AMQReader.
+        """
+        if iuid is None or self.size <= 0:
+            return
+        # the iuids are also received as headers, i.e. strings
+        iuid = str(iuid)
+        index = self.indexes.setdefault(destination, OrderedDict())
+        index[iuid] = iu
+        index.move_to_end(iuid)
+        if len(index) > self.size:
+            index.popitem(last=False)
+
+    def get(self, iuid, destination=None):
+        """Returns the IU corresponding to a producer's iuid, looking in `destination`'s index first, None if the IU is
+        not (or no longer) indexed.
+
+        Args:
+            iuid (str): the iuid of the IU on the producer's side.
+            destination (str): the ActiveMQ destination the IU most probably comes from.
+        """
+        if iuid is None:
+            return None
+        iuid = str(iuid)
+        index = self.indexes.get(destination)
+        if index is not None and iuid in index:
+            index.move_to_end(iuid)
+            return index[iuid]
+        for other_destination, index in self.indexes.items():
+            if other_destination != destination and iuid in index:
+                index.move_to_end(iuid)
+                return index[iuid]
+        return None
+
+
+class DestinationRouter:
+    """Trie of ActiveMQ destination patterns, resolving the concrete destination of a received message to the value
+    (e.g. IU type) of the pattern it matches.
+    Patterns follow ActiveMQ's wildcard syntax : the name after the `/topic/` or `/queue/` prefix is split into
+    elements separated by `.`, `*` matches any single element, and `>` matches one or more trailing elements (e.g.
+    `/topic/agent.*.ASR` or `/topic/ASR.>`). When several patterns match, literal elements are preferred over `*`, and
+    `*` over `>`.
+    The resolutions of concrete destinations are cached.
+    """
+
+    def __init__(self, cache_size=1024):
+        """Initializes the DestinationRouter.
+
+        Args:
+            cache_size (int): maximum number of cached resolutions.
+        """
+        self.root = dict()
+        self.cache = dict()
+        self.cache_size = cache_size
+
+    @staticmethod
+    def split(destination):
+        """Splits a destination into its prefix (e.g. `/topic/`) and the elements of its name."""
+        prefix, _, name = destination.rpartition("/")
+        return [prefix + "/"] + name.split(".")
+
+    def add(self, pattern, value):
+        """Adds a destination pattern.
+
+        Args:
+            pattern (str): the destination or destination pattern.
+            value (object): the value returned for the destinations matching the pattern.
+        """
+        node = self.root
+        for element in self.split(pattern):
+            node = node.setdefault(element, dict())
+        # None can't be an element, as elements are strings
+        node[None] = value
+        self.cache.clear()
+
+    def resolve(self, destination):
+        """Returns the value of the pattern matching a concrete destination, None if no pattern matches.
+
+        Args:
+            destination (str): the concrete destination of a received message.
+        """
+        if destination in self.cache:
+            return self.cache[destination]
+        value = self._resolve(self.root, self.split(destination), 0)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[destination] = value
+        return value
+
+    def _resolve(self, node, elements, i):
+        if i == len(elements):
+            return node.get(None)
+        for key in (elements[i], "*"):
+            child = node.get(key)
+            if child is not None:
+                value = self._resolve(child, elements, i + 1)
+                if value is not None:
+                    return value
+        # the prefix can't be matched by `>`
+        if i > 0 and ">" in node:
+            return node[">"].get(None)
+        return None
+
+
+def join_thread(thread, timeout=1.0):
+    """Joins a module's worker thread, unless it is the calling thread (the module being shut down from its own
+    thread)."""
+    if thread is not None and thread is not threading.current_thread():
+        thread.join(timeout)
+
+
+def disconnect_stomp(conn):
+    """Disconnects a stomp connection, stopping its receiver and heartbeat threads."""
+    if conn is None or not conn.is_connected():
+        return
+    try:
+        conn.disconnect()
+    except Exception:
+        # the connection was lost meanwhile
+        pass
+
+
+def reconnect_with_backoff(owner, module, is_running, initial_delay=0.1, max_delay=5.0):
+    """Reconnects to ActiveMQ, retrying with an exponential backoff until the connection succeeds or the module stops
+    running. Only one reconnection of `owner` runs at a time.
+
+    Args:
+        owner (object): the object to reconnect (module or consumer), with `connect`, `conn` and `reconnect_lock`.
+        module (AbstractModule): the module logging the attempts and counting them in its metrics.
+        is_running (Callable[[], bool]): returns False once the module is shutting down.
+        initial_delay (float): the delay in seconds after the first failed attempt.
+        max_delay (float): the maximum delay in seconds between two attempts.
+
+    Returns:
+        bool: True if the connection was reestablished.
+    """
+    if not owner.reconnect_lock.acquire(blocking=False):
+        return False
+    try:
+        delay = initial_delay
+        attempt = 0
+        while is_running():
+            attempt += 1
+            try:
+                owner.connect()
+            except Exception:
+                module.metrics.inc("amq_reconnect_failures_total")
+                module.terminal_logger.warning(
+                    "reconnection to ActiveMQ failed", attempt=attempt, retry_in=delay
+                )
+            else:
+                if not is_running():
+                    # the module was shut down during the reconnection
+                    disconnect_stomp(owner.conn)
+                    return False
+                module.metrics.inc("amq_reconnects_total")
+                return True
+            deadline = time.monotonic() + delay
+            while is_running() and time.monotonic() < deadline:
+                time.sleep(min(0.1, delay))
+            delay = min(delay * 2, max_delay)
+        return False
+    finally:
+        owner.reconnect_lock.release()
 
 
 class AMQIU(retico_core.IncrementalUnit):
@@ -40,6 +669,7 @@ class AMQIU(retico_core.IncrementalUnit):
         decorated_iu=None,
         headers=None,
         destination=None,
+        qos=None,
         **kwargs,
     ):
         super().__init__(
@@ -51,14 +681,175 @@ class AMQIU(retico_core.IncrementalUnit):
         self.decorated_iu = decorated_iu
         self.headers = headers
         self.destination = destination
+        self.qos = get_qos_profile(qos)
 
     def get_deco_iu(self):
         return self.decorated_iu
 
-    def set_amq(self, decorated_iu, headers, destination):
+    def set_amq(self, decorated_iu, headers, destination, qos=None):
+        self.decorated_iu = decorated_iu
+        self.headers = headers
+        self.destination = destination
+        self.qos = get_qos_profile(qos)
+
+
+class CompactAMQIU(AMQIU):
+    """Allocation-light AMQIU created by AMQBridge, only referencing the decorated IU and the headers, destination and
+    QoS shared by all the IUs of the bridge.
+    It has no `previous_iu` chain and no lock, and its `meta_data` and processed list are only allocated when used, so
+    that it does not keep the past IUs alive. Its own attributes are stored in slots, but as IncrementalUnit doesn't
+    define `__slots__`, an instance still has a `__dict__`, only filled if other attributes are assigned.
+    It has its own iuid, so that it is not equal (retico compares IUs by iuid) to the IU it decorates.
+    """
+
+    __slots__ = (
+        "creator",
+        "creator_id",
+        "iuid",
+        "grounded_in",
+        "created_at",
+        "decorated_iu",
+        "headers",
+        "destination",
+        "qos",
+        "_meta_data",
+        "_processed",
+    )
+
+    # shared by all CompactAMQIUs, assigning them on an instance is still possible
+    previous_iu = None
+    payload = None
+    committed = False
+    revoked = False
+    _processed_lock = threading.Lock()
+
+    def __init__(
+        self, creator, iuid, decorated_iu, headers=None, destination=None, qos=None
+    ):
+        """Initializes the CompactAMQIU.
+
+        Args:
+            creator (AbstractModule): the module creating the IU.
+            iuid (str): the iuid of the IU.
+            decorated_iu (IncrementalUnit): the IU to send, also the IU this one is grounded in.
+            headers (Mapping): the ActiveMQ headers to be sent with the message, shared between IUs.
+            destination (str): the ActiveMQ destination to send the message to.
+            qos (QoSProfile): the QoS profile of the message.
+        """
+        self.creator = creator
+        self.creator_id = getattr(creator, "id", None)
+        self.iuid = iuid
+        self.grounded_in = decorated_iu
+        self.created_at = time.time()
         self.decorated_iu = decorated_iu
         self.headers = headers
         self.destination = destination
+        self.qos = qos
+        self._meta_data = None
+        self._processed = ()
+
+    @property
+    def meta_data(self):
+        if self._meta_data is None:
+            self._meta_data = dict(getattr(self.decorated_iu, "meta_data", None) or {})
+        return self._meta_data
+
+    @meta_data.setter
+    def meta_data(self, meta_data):
+        self._meta_data = meta_data
+
+    def processed_list(self):
+        return list(self._processed)
+
+    def set_processed(self, module):
+        if not isinstance(module, retico_core.AbstractModule):
+            raise TypeError("Given object is not a module!")
+        with self._processed_lock:
+            self._processed = self._processed + (module,)
+
+    def is_processed_by(self, module):
+        return module in self._processed
+
+
+class AMQConsumer:
+    """One of the competing consumers of an AMQReader's destination, with its own connection, queue, sequencer and
+    processing thread. ActiveMQ shares the destination's messages between the consumers, and delivers all the messages
+    of a message group (`JMSXGroupID` header) to the same consumer.
+    """
+
+    def __init__(self, reader, destination, prefetch=10, index=0):
+        """Initializes the AMQConsumer.
+
+        Args:
+            reader (AMQReader): the reader creating the IUs from the received messages.
+            destination (str): the ActiveMQ queue to consume.
+            prefetch (int): maximum number of messages ActiveMQ dispatches to the consumer ahead of its processing.
+            index (int): the index of the consumer in its destination's consumers.
+        """
+        self.reader = reader
+        self.destination = destination
+        self.prefetch = prefetch
+        self.index = index
+        self.conn = None
+        self.reconnect_lock = threading.Lock()
+        self.thread = None
+        self.queue = PriorityLanes(starvation_timeout=reader.queue.starvation_timeout)
+        self.sequencer = SequenceTracker(
+            reorder_timeout=reader.sequencer.reorder_timeout,
+            reorder_size=reader.sequencer.reorder_size,
+            dedup_window=reader.sequencer.dedup_window,
+            grouped_only=True,
+            max_streams=reader.sequencer.max_streams,
+        )
+
+    def connect(self):
+        """Connects to ActiveMQ, and subscribes to the destination."""
+        try:
+            self.conn = stomp.Connection(
+                host_and_ports=self.reader.hosts, auto_content_length=False
+            )
+            self.conn.set_listener("", AMQReader.Listener(self))
+            self.conn.connect("admin", "admin", wait=True)
+            self.conn.subscribe(
+                destination=self.destination,
+                id=1,
+                ack="auto",
+                headers={"activemq.prefetchSize": str(self.prefetch)},
+            )
+        except stomp.exception.ConnectFailedException as e:
+            log_exception(module=self.reader, exception=e)
+            raise stomp.exception.ConnectFailedException from e
+
+    def start(self):
+        """Starts processing the received messages."""
+        self.thread = threading.Thread(
+            target=self.reader.run_process, args=(self.queue, self.sequencer)
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Joins the processing thread, and closes the connection."""
+        join_thread(self.thread)
+        self.thread = None
+        disconnect_stomp(self.conn)
+
+    def on_message(self, frame):
+        self.reader.on_message(frame, self.queue)
+
+    def on_listener_error(self, frame):
+        self.reader.on_listener_error(frame)
+
+    def on_disconnected(self):
+        if not self.reader._tts_thread_active:
+            return
+        self.reader.terminal_logger.warning(
+            "AMQReader consumer is disconnected from ActiveMQ",
+            destination=self.destination,
+            consumer=self.index,
+        )
+        reconnect_with_backoff(
+            self, self.reader, lambda: self.reader._tts_thread_active
+        )
 
 
 class AMQReader(retico_core.AbstractProducingModule):
@@ -80,21 +871,118 @@ class AMQReader(retico_core.AbstractProducingModule):
     def output_iu():
         return IncrementalUnit
 
-    def __init__(self, ip, port, print=False, **kwargs):
+    def __init__(
+        self,
+        ip,
+        port,
+        print=False,
+        starvation_timeout=0.5,
+        reorder_timeout=0.05,
+        reorder_size=64,
+        dedup_window=1024,
+        iu_index_size=256,
+        decode_workers=0,
+        decode_executor="process",
+        decode_threshold=65536,
+        decoder=json.loads,
+        profile=False,
+        max_streams=256,
+        **kwargs,
+    ):
         """Initializes the ActiveMQReader.
 
         Args:
             ip (str): the IP of the computer.
             port (str): the port corresponding to ActiveMQ
             print (bool): boolean that manages printing
+            starvation_timeout (float): maximum time in seconds a message can wait in a lane while more urgent lanes are
+                processed.
+            reorder_timeout (float): maximum time in seconds a message can wait for the missing messages of its
+                producer.
+            reorder_size (int): maximum number of messages waiting for missing messages, per producer.
+            dedup_window (int): number of message ids remembered to suppress duplicates of unsequenced messages.
+            iu_index_size (int): number of received IUs remembered per destination to resolve the `previous_iu` and
+                `grounded_in` of the next IUs.
+            decode_workers (int): number of workers decoding the message bodies in parallel, 0 decodes them in the
+                processing thread.
+            decode_executor (str): "process" to decode in a process pool, "thread" to decode in a thread pool (only
+                useful with a `decoder` releasing the GIL).
+            decode_threshold (int): size in characters from which a message body is decoded by the pool, smaller
+                bodies are decoded in the processing thread.
+            decoder (Callable[[str], dict]): the function decoding the message bodies, it has to be picklable (e.g. a
+                module-level function) to be used in a process pool, whose workers are started with "forkserver" (or
+                "spawn" where it is not available).
+            profile (bool): True to record the wall and CPU time of each stage of the hot paths in the metrics.
+            max_streams (int): number of producer streams (producer, destination, priority, message group) whose
+                sequence and last IU are remembered, the least recently used streams being forgotten.
         """
         super().__init__(**kwargs)
         self.hosts = [(ip, port)]
         self.conn = None
+        self.reconnect_lock = threading.Lock()
         self.target_iu_types = dict()
-        self.queue = deque()
+        self.router = DestinationRouter()
+        # AMQRequesters receiving their replies through the module's connection
+        self.requesters = []
+        self.priority_rules = []
+        self.queue = PriorityLanes(starvation_timeout=starvation_timeout)
         self._tts_thread_active = False
+        self._thread = None
         self.print = print
+        self.sequencer = SequenceTracker(
+            reorder_timeout=reorder_timeout,
+            reorder_size=reorder_size,
+            dedup_window=dedup_window,
+            max_streams=max_streams,
+        )
+        # producer stream -> last IU created from this stream, least recently used first
+        self._previous_ius = OrderedDict()
+        self.max_streams = max_streams
+        # the competing consumers create IUs concurrently
+        self.iu_lock = threading.Lock()
+        self.consumers = []
+        self.iu_index = IUIndex(size=iu_index_size)
+        self.decode_workers = decode_workers
+        self.decode_executor = decode_executor
+        self.decode_threshold = decode_threshold
+        self.decoder = decoder
+        self.decode_pool = None
+        self.shm_reader = SharedMemoryReader()
+        self.metrics = AMQMetrics()
+        self.register_metrics()
+        self.profiler = StageProfiler(self.metrics, enabled=profile)
+
+    def register_metrics(self):
+        """Registers the gauges of the module's metrics : queue depth and latency per lane, ordering and IU index
+        statistics.
+        """
+        for lane in range(len(self.queue.lanes)):
+            self.metrics.register(
+                "amq_queue_depth",
+                lambda lane=lane: len(self.queue.lanes[lane]),
+                lane=lane,
+            )
+            self.metrics.register(
+                "amq_queue_mean_latency_seconds",
+                lambda lane=lane: self.queue.lane_stats()[lane]["mean_latency"],
+                lane=lane,
+            )
+        self.metrics.register(
+            "amq_duplicates_total", lambda: self.sequencer.nb_duplicates, "counter"
+        )
+        self.metrics.register(
+            "amq_reordered_total", lambda: self.sequencer.nb_reordered, "counter"
+        )
+        self.metrics.register(
+            "amq_gaps_total", lambda: self.sequencer.nb_gaps, "counter"
+        )
+        self.metrics.register(
+            "amq_reorder_pending", lambda: self.sequencer.stats()["pending"]
+        )
+        self.metrics.register("amq_iu_index_size", lambda: len(self.iu_index))
+        self.metrics.register(
+            "amq_sequence_streams", lambda: len(self.sequencer.expected)
+        )
 
     def process_update(self, update_message):
         if self._tts_thread_active:
@@ -102,29 +990,121 @@ class AMQReader(retico_core.AbstractProducingModule):
 
     def setup(self):
         super().setup()
+        self.connect()
+        for consumer in self.consumers:
+            consumer.connect()
+
+    def connect(self):
+        """Connects to ActiveMQ, and subscribes to the added destinations."""
         try:
             self.conn = stomp.Connection(
                 host_and_ports=self.hosts, auto_content_length=False
             )
-            self.conn.connect("admin", "admin", wait=True)
             self.conn.set_listener("", self.Listener(self))
-            for destination in self.target_iu_types:
-                self.conn.subscribe(destination=destination, id=1, ack="auto")
+            self.conn.connect("admin", "admin", wait=True)
+            for i, destination in enumerate(self.target_iu_types):
+                self.conn.subscribe(destination=destination, id=i + 1, ack="auto")
+            for requester in self.requesters:
+                self.subscribe_requester(requester)
         except stomp.exception.ConnectFailedException as e:
             log_exception(module=self, exception=e)
             raise stomp.exception.ConnectFailedException from e
 
+    def add_requester(self, requester):
+        """Receives the replies of an AMQRequester through the module's connection.
+
+        Args:
+            requester (AMQRequester): the requester.
+        """
+        self.requesters.append(requester)
+        if self.conn is not None and self.conn.is_connected():
+            self.subscribe_requester(requester)
+
+    def subscribe_requester(self, requester):
+        """Subscribes to the reply destination of an AMQRequester."""
+        self.conn.subscribe(
+            destination=requester.reply_destination,
+            id=f"reply-{self.requesters.index(requester)}",
+            ack="auto",
+        )
+
+    def find_requester(self, frame):
+        """Returns the AMQRequester waiting for a received message (with the message's `correlation-id` header), None if
+        the message is not an expected reply.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+        """
+        correlation_id = frame.headers.get("correlation-id")
+        if correlation_id is None:
+            return None
+        for requester in self.requesters:
+            if requester.expects(correlation_id):
+                return requester
+        return None
+
+    def on_listener_error(self, frame):
+        """The function that is triggered every time ActiveMQ sends an ERROR frame.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ error.
+        """
+        self.metrics.inc("amq_broker_errors_total")
+        self.terminal_logger.error(
+            "AMQReader receives an error from ActiveMQ", message=frame.body
+        )
+
+    def on_disconnected(self):
+        """The function that is triggered when the connection to ActiveMQ is lost. While the module is running, it
+        tries to reconnect, waiting longer after each failed attempt.
+        """
+        if not self._tts_thread_active:
+            return
+        self.terminal_logger.warning("AMQReader is disconnected from ActiveMQ")
+        reconnect_with_backoff(self, self, lambda: self._tts_thread_active)
+
     def prepare_run(self):
         super().prepare_run()
+        if self.decode_workers > 0:
+            if self.decode_executor == "process":
+                # the stomp threads are already running, forking them could deadlock the workers
+                start_method = (
+                    "forkserver"
+                    if "forkserver" in multiprocessing.get_all_start_methods()
+                    else "spawn"
+                )
+                self.decode_pool = ProcessPoolExecutor(
+                    max_workers=self.decode_workers,
+                    mp_context=multiprocessing.get_context(start_method),
+                )
+            elif self.decode_executor == "thread":
+                self.decode_pool = ThreadPoolExecutor(max_workers=self.decode_workers)
+            else:
+                raise ValueError(
+                    f"decode_executor should be 'process' or 'thread', not {self.decode_executor}"
+                )
         self._tts_thread_active = True
-        threading.Thread(target=self.run_process).start()
+        self._thread = threading.Thread(target=self.run_process)
+        self._thread.start()
+        for consumer in self.consumers:
+            consumer.start()
 
     def shutdown(self):
         """
         overrides AbstractModule : https://github.com/retico-team/retico-core/blob/main/retico_core/abstract.py#L819
+        The processing thread is joined, and the connection closed, so that no thread outlives the module.
         """
         super().shutdown()
         self._tts_thread_active = False
+        join_thread(self._thread)
+        self._thread = None
+        for consumer in self.consumers:
+            consumer.stop()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown(wait=False, cancel_futures=True)
+            self.decode_pool = None
+        self.shm_reader.close()
+        disconnect_stomp(self.conn)
 
     class Listener(stomp.ConnectionListener):
         """Listener that triggers ANQReader's `on_message` function every time a message is unqueued in one of the subscribed destination."""
@@ -143,120 +1123,544 @@ class AMQReader(retico_core.AbstractProducingModule):
             # self.module.logMessageReception(frame)
             self.module.on_message(frame)
 
-    def add(self, destination, target_iu_type):
+        def on_disconnected(self):
+            self.module.on_disconnected()
+
+    def add(
+        self,
+        destination,
+        target_iu_type,
+        consumers=1,
+        consumer_group="retico",
+        prefetch=10,
+    ):
         """Stores the destination to subscribe to and the corresponding desired IU type in `target_iu_type`.
+        The destination can use ActiveMQ wildcards (e.g. `/topic/agent.*.ASR` or `/topic/ASR.>`).
+        With several consumers, the messages of the destination are shared between competing consumers, each with its
+        own connection and processing thread. The destination has to be a queue, or a virtual topic
+        (`/topic/VirtualTopic.<name>`, consumed through the `/queue/Consumer.<consumer_group>.VirtualTopic.<name>`
+        queue). The messages of a message group (see `AMQWriter.set_group_by`) are processed in order by a single
+        consumer.
 
         Args:
-            destination (_type_): the ActiveMQ destination to subscribe to.
-            target_iu_type (dict): dictionary of all destination-IU type associations.
+            destination (str): the ActiveMQ destination (or destination pattern) to subscribe to.
+            target_iu_type (type): the IU type created from the messages received on the destination.
+            consumers (int): number of competing consumers, 1 to receive the messages on the module's connection.
+            consumer_group (str): the name of the consumers of a virtual topic.
+            prefetch (int): maximum number of messages ActiveMQ dispatches to a consumer ahead of its processing.
         """
-        self.target_iu_types[destination] = target_iu_type
+        self.router.add(destination, target_iu_type)
+        if consumers <= 1:
+            self.target_iu_types[destination] = target_iu_type
+            return
+        queue = self.consumer_queue(destination, consumer_group)
+        self.router.add(queue, target_iu_type)
+        for i in range(consumers):
+            consumer = AMQConsumer(self, queue, prefetch=prefetch, index=i)
+            self.consumers.append(consumer)
+            self.metrics.register(
+                "amq_consumer_queue_depth",
+                lambda consumer=consumer: len(consumer.queue),
+                destination=queue,
+                consumer=i,
+            )
 
-    def on_message(self, frame):
+    @staticmethod
+    def consumer_queue(destination, consumer_group):
+        """Returns the queue consumed by the competing consumers of a destination.
+
+        Args:
+            destination (str): a queue, or a virtual topic.
+            consumer_group (str): the name of the consumers of a virtual topic.
+        """
+        if destination.startswith("/queue/"):
+            return destination
+        name = destination[len("/topic/") :]
+        if destination.startswith("/topic/") and name.startswith("VirtualTopic."):
+            return f"/queue/Consumer.{consumer_group}.{name}"
+        raise ValueError(
+            f"competing consumers need a queue or a virtual topic, not {destination}"
+        )
+
+    def add_priority(self, lane, destination=None, predicate=None):
+        """Adds a rule classifying the received messages into a priority lane. Rules are checked in insertion order, and
+        messages matching no rule are classified with their STOMP `priority` header.
+
+        Args:
+            lane (int): the lane of the matching messages (`PRIORITY_CONTROL`, `PRIORITY_DEFAULT` or `PRIORITY_BULK`).
+            destination (str): the ActiveMQ destination the rule applies to, None for all destinations.
+            predicate (Callable[[stomp.frame], bool]): function selecting the matching frames, None for all frames.
+        """
+        self.priority_rules.append((lane, destination, predicate))
+
+    def frame_lane(self, frame):
+        """Returns the priority lane of a received message.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+        """
+        lane = match_priority_rules(
+            self.priority_rules, frame.headers.get("destination"), frame
+        )
+        if lane is None and self.find_requester(frame) is not None:
+            lane = PRIORITY_CONTROL
+        if lane is None:
+            lane = stomp_priority_to_lane(frame.headers.get("priority"))
+        return lane
+
+    @staticmethod
+    def ordering_keys(frame):
+        """Returns the ordering keys of a received message : the (destination, iuid) of its IUs, and its stream.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+        """
+        destination = frame.headers["destination"]
+        keys = [(destination, iuid) for iuid in message_iuids(frame.headers)]
+        keys.append(SequenceTracker.stream(frame))
+        return keys
+
+    @staticmethod
+    def ordered_lane(keys, queue, lane):
+        """Returns the lane of a received message, moved back to the lane of a waiting message of the same IUs if that
+        lane is less urgent, so that the updates of an IU are processed in order (e.g. a REVOKE doesn't overtake the
+        ADD of its IU). The message is also kept behind the waiting messages of its stream that were moved back, so that
+        the stream stays in sequence order.
+
+        Args:
+            keys (list): the ordering keys of the message, from `ordering_keys`.
+            queue (PriorityLanes): the queue the message is added to.
+            lane (int): the lane of the message.
+        """
+        waiting_lane = queue.last_lane(keys, lane)
+        return lane if waiting_lane is None else waiting_lane
+
+    def on_message(self, frame, queue=None):
         """The function that is triggered every time a message (= `frame`)is unqueued in one of the subscribed destination.
         The message is then processed an transformed into an IU of the corresponding type.
 
         Args:
             frame (stomp.frame): the received ActiveMQ message.
+            queue (PriorityLanes): the queue of the consumer receiving the message, the module's queue by default.
         """
-        # check if it doesn't throw exception ? in case some frame parameter is not printable
-        self.terminal_logger.info(
-            "AMQReader receives a message from ActiveMQ",
-            destination=frame.headers["destination"],
-            # headers=frame.headers,
-            # message=frame.body,
-        )
-        self.queue.append(frame)
+        with self.profiler.stage("on_message"):
+            # check if it doesn't throw exception ? in case some frame parameter is not printable
+            with self.profiler.stage("log"):
+                self.terminal_logger.info(
+                    "AMQReader receives a message from ActiveMQ",
+                    destination=frame.headers["destination"],
+                    # headers=frame.headers,
+                    # message=frame.body,
+                )
+            destination = frame.headers["destination"]
+            self.metrics.inc("amq_messages_received_total", destination=destination)
+            self.metrics.inc(
+                "amq_bytes_received_total", len(frame.body), destination=destination
+            )
+            queue = self.queue if queue is None else queue
+            keys = self.ordering_keys(frame)
+            lane = self.ordered_lane(keys, queue, self.frame_lane(frame))
+            queue.append(frame, lane=lane, keys=keys)
 
-    def run_process(self):
+    def run_process(self, queue=None, sequencer=None):
         """Function that will run on a separate thread and process the ActiveMQ messages received, and previous append in the class parameter `queue`.
+        The most urgent priority lanes are processed first, and the messages of each producer are processed in order,
+        without duplicates.
 
-        Returns:
-            _type_: _description_
+        Args:
+            queue (PriorityLanes): the queue of the messages to process, the module's queue by default.
+            sequencer (SequenceTracker): the sequencer of the messages, the module's sequencer by default.
         """
+        queue = self.queue if queue is None else queue
+        sequencer = self.sequencer if sequencer is None else sequencer
         while self._tts_thread_active:
             try:
-                time.sleep(0.2)
-                if len(self.queue) > 0:
-                    frame = self.queue.popleft()
-                    message = frame.body
-                    destination = frame.headers["destination"]
-
-                    if destination not in self.target_iu_types:
-                        print(destination, "is not a recognized destination")
-                        return None
-
-                    try:
-                        # try to parse the message to create a dict (it has to be a structured message JSON), and put it in the IU's init parameters.
-                        # create the decorated IU (cannot use classical create_iu from AbstractModule)
-                        msg_json = json.loads(message)
-                        iu_type = self.target_iu_types[destination]
-                        init_args = iu_type.__init__.__code__.co_varnames
-                        common_args = msg_json.keys() & init_args
-                        deleted_args = msg_json.keys() - init_args
-                        # print(common_args)
-                        # print(deleted_args)
-                        msg_json_filtered = {key: msg_json[key] for key in common_args}
-                        output_iu = self.target_iu_types[destination](
-                            creator=self,
-                            iuid=f"{hash(self)}:{self.iu_counter}",
-                            previous_iu=self._previous_iu,
-                            grounded_in=None,
-                            **msg_json_filtered,
-                        )
-                        if self.print:
-                            print(
-                                "JSON MESSAGE RECEIVED: \n",
-                                json.dumps(msg_json, indent=2),
-                            )
-                        self.terminal_logger.info(
-                            "AMQReader creates new iu",
+                frame = queue.get(timeout=sequencer.reorder_timeout)
+                frames = sequencer.flush()
+                # with a decode pool, take all waiting messages so that they are decoded in parallel
+                nb_frames = 1 if self.decode_pool is None else self.decode_workers * 2
+                while frame is not None:
+                    # drop the messages that expired while waiting, before decoding them
+                    if is_expired(frame):
+                        self.metrics.inc(
+                            "amq_expired_messages_total",
                             destination=frame.headers["destination"],
-                            ID=msg_json["requestID"],
                         )
+                    else:
+                        frames.extend(sequencer.push(frame))
+                    if len(frames) >= nb_frames:
+                        break
+                    frame = queue.get(timeout=0)
+                frames = [
+                    sub_frame for frame in frames for sub_frame in self.unbatch(frame)
+                ]
+                # the bodies are decoded in parallel, but the frames are processed in order
+                decoded = [self.submit_decode(frame) for frame in frames]
+                for frame, future in zip(frames, decoded):
+                    try:
+                        with self.profiler.stage("process_frame"):
+                            self.process_frame(frame, future)
                     except Exception as e:
-                        # if message not parsable as a structured message (JSON), then put it as the IU's payload.
-                        # create the decorated IU (cannot use classical create_iu from AbstractModule)
                         log_exception(module=self, exception=e)
-                        output_iu = self.target_iu_types[destination](
-                            creator=self,
-                            iuid=f"{hash(self)}:{self.iu_counter}",
-                            previous_iu=self._previous_iu,
-                            grounded_in=None,
-                            # payload=message,
-                        )
-                    self.terminal_logger.info(
-                        "create_iu",
-                        iuid=output_iu.iuid,
-                        previous_iu=(
-                            output_iu.previous_iu.iuid
-                            if output_iu.previous_iu is not None
-                            else None
-                        ),
-                        grounded_in=(
-                            output_iu.grounded_in.iuid
-                            if output_iu.grounded_in is not None
-                            else None
-                        ),
-                    )
-
-                    self.iu_counter += 1
-                    self._previous_iu = output_iu
-                    update_message = retico_core.UpdateMessage()
-
-                    if "update_type" not in frame.headers:
-                        # print("Incoming IU has no update_type!")
-                        update_message.add_iu(output_iu, retico_core.UpdateType.ADD)
-                    elif frame.headers["update_type"] == "UpdateType.ADD":
-                        update_message.add_iu(output_iu, retico_core.UpdateType.ADD)
-                    elif frame.headers["update_type"] == "UpdateType.REVOKE":
-                        update_message.add_iu(output_iu, retico_core.UpdateType.REVOKE)
-                    elif frame.headers["update_type"] == "UpdateType.COMMIT":
-                        update_message.add_iu(output_iu, retico_core.UpdateType.COMMIT)
-                    self.append(update_message)
             except Exception as e:
                 log_exception(module=self, exception=e)
 
+    def unbatch(self, frame):
+        """Splits a batch message sent by AMQWriter (`amq-batch` header) into the messages it contains, dropping the
+        expired ones. Only the batch's index is decoded here, the bodies of the messages are decoded like the bodies of
+        the other messages (by the decode pool if they are big enough).
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+
+        Returns:
+            list: the messages to process.
+        """
+        if "amq-batch" not in frame.headers:
+            return [frame]
+        try:
+            body = self.read_body(frame)
+            if isinstance(body, bytes):
+                body = body.decode()
+            index, _, bodies = body.partition("\n")
+            batch = json.loads(index)
+        except Exception as e:
+            log_exception(module=self, exception=e)
+            self.metrics.inc(
+                "amq_decode_failures_total", destination=frame.headers["destination"]
+            )
+            return []
+        batch_headers = dict(frame.headers)
+        batch_headers.pop("amq-batch")
+        batch_headers.pop("amq-shm", None)
+        batch_headers.pop("amq-iuid", None)
+        frames = []
+        offset = 0
+        for message_headers, length in batch:
+            sub_frame = stomp.utils.Frame(
+                frame.cmd,
+                {**batch_headers, **message_headers},
+                bodies[offset : offset + length],
+            )
+            offset += length
+            if is_expired(sub_frame):
+                self.metrics.inc(
+                    "amq_expired_messages_total",
+                    destination=frame.headers["destination"],
+                )
+            else:
+                frames.append(sub_frame)
+        return frames
+
+    @staticmethod
+    def is_header_only(frame):
+        """Returns True if a message is a REVOKE or COMMIT of an IU identified by its `amq-iuid` header, that can be
+        resolved from the IU index without decoding the body.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+        """
+        update_type = UPDATE_TYPES.get(frame.headers.get("update_type"))
+        return update_type in HEADER_ONLY_UPDATE_TYPES and "amq-iuid" in frame.headers
+
+    def submit_decode(self, frame):
+        """Submits the decoding of a message body to the decode pool, if there is one and the body is big enough.
+        The body of a message sent through shared memory (`amq-shm` header) is read from the writer's segment here, and
+        only decoded by the pool.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+
+        Returns:
+            concurrent.futures.Future: the future decoded body, None if the body has to be decoded by `decode_body`.
+        """
+        if self.decode_pool is None:
+            return None
+        handle = frame.headers.get("amq-shm")
+        try:
+            # the body sent through shared memory is not in the frame, its length is given by the handle
+            size = len(frame.body) if handle is None else parse_shm_handle(handle)[3]
+        except ValueError:
+            return None
+        if size < self.decode_threshold:
+            return None
+        if self.router.resolve(frame.headers["destination"]) is None:
+            return None
+        if self.is_header_only(frame):
+            return None
+        try:
+            body = self.read_body(frame)
+        except ValueError as e:
+            # the body is lost, the message is dropped when the decoded body is collected
+            future = Future()
+            future.set_exception(e)
+            return future
+        return self.decode_pool.submit(self.decoder, body)
+
+    def decode_body(self, frame, decoded=None):
+        """Returns the decoded body of a message.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+            decoded (concurrent.futures.Future): the body decoded by the decode pool, None to decode it now. The body of a
+                message sent through shared memory (`amq-shm` header) is read from the writer's segment.
+        """
+        with self.profiler.stage("decode"):
+            return self._decode_body(frame, decoded)
+
+    def _decode_body(self, frame, decoded):
+        if decoded is not None:
+            return decoded.result()
+        return self.decoder(self.read_body(frame))
+
+    def read_body(self, frame):
+        """Returns the body of a message, read from the writer's segment for a message sent through shared memory
+        (`amq-shm` header).
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+        """
+        handle = frame.headers.get("amq-shm")
+        if handle is None:
+            return frame.body
+        # the body was written in the shared memory of a co-located writer
+        body = self.shm_reader.read(handle)
+        if body is None:
+            self.metrics.inc(
+                "amq_shm_failures_total", destination=frame.headers["destination"]
+            )
+            raise ValueError(f"shared memory body {handle} is not available")
+        return body
+
+    def process_frame(self, frame, decoded=None):
+        """Transforms an ActiveMQ message into an IU of the destination's IU type, and appends it to the module's
+        output. An envelope message (`amq-envelope` header), containing several IUs with their update types, is
+        transformed into a single UpdateMessage.
+        A REVOKE or COMMIT message of an IU still in the IU index (`amq-iuid` header) is applied to this IU without
+        decoding the body.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+            decoded (concurrent.futures.Future): the body decoded by the decode pool, None to decode it now.
+        """
+        destination = frame.headers["destination"]
+
+        requester = self.find_requester(frame)
+        if requester is not None:
+            self.process_reply(requester, frame, decoded)
+            return None
+
+        iu_type = self.router.resolve(destination)
+        if iu_type is None:
+            # skip the message, but keep processing the next ones
+            self.metrics.inc("amq_unknown_destination_total", destination=destination)
+            self.terminal_logger.warning(
+                "AMQReader receives a message from an unknown destination",
+                destination=destination,
+            )
+            return None
+
+        update_message = retico_core.UpdateMessage()
+        if frame.headers.get("amq-envelope") == "1":
+            try:
+                envelope = self.decode_body(frame, decoded)["envelope"]
+            except Exception as e:
+                log_exception(module=self, exception=e)
+                self.metrics.inc("amq_decode_failures_total", destination=destination)
+                return None
+            for entry in envelope:
+                update_type = UPDATE_TYPES[entry["update_type"]]
+                output_iu = None
+                # a REVOKE or COMMIT refers to an IU received before, which is updated instead of a new copy
+                if update_type in HEADER_ONLY_UPDATE_TYPES:
+                    with self.iu_lock:
+                        output_iu = self.iu_index.get(
+                            entry["iu"].get("requestID"), destination
+                        )
+                    if output_iu is not None:
+                        self.metrics.inc(
+                            "amq_header_only_updates_total", destination=destination
+                        )
+                if output_iu is None:
+                    output_iu = self.create_iu_from_json(frame, entry["iu"])
+                update_message.add_iu(output_iu, update_type)
+            with self.profiler.stage("append"):
+                self.append(update_message)
+            return None
+
+        update_type = UPDATE_TYPES.get(frame.headers.get("update_type", "add"))
+        if update_type is None:
+            self.metrics.inc("amq_unknown_update_type_total", destination=destination)
+            self.terminal_logger.warning(
+                "AMQReader receives a message with an unknown update type",
+                destination=destination,
+                update_type=frame.headers["update_type"],
+            )
+            return None
+
+        # a REVOKE or COMMIT refers to an IU received before, that doesn't have to be decoded again
+        if self.is_header_only(frame):
+            with self.iu_lock:
+                output_iu = self.iu_index.get(frame.headers["amq-iuid"], destination)
+            if output_iu is not None:
+                self.metrics.inc(
+                    "amq_header_only_updates_total", destination=destination
+                )
+                update_message.add_iu(output_iu, update_type)
+                with self.profiler.stage("append"):
+                    self.append(update_message)
+                return None
+
+        try:
+            # try to parse the message to create a dict (it has to be a structured message JSON), and put it in the IU's init parameters.
+            msg_json = self.decode_body(frame, decoded)
+            output_iu = self.create_iu_from_json(frame, msg_json)
+        except Exception as e:
+            # if message not parsable as a structured message (JSON), then put it as the IU's payload.
+            # create the decorated IU (cannot use classical create_iu from AbstractModule)
+            log_exception(module=self, exception=e)
+            self.metrics.inc("amq_decode_failures_total", destination=destination)
+            if "amq-shm" in frame.headers:
+                # the body is lost (segment on another host, or slot already reused), no empty IU is created
+                self.metrics.inc("amq_shm_dropped_total", destination=destination)
+                return None
+            output_iu = iu_type(
+                creator=self,
+                iuid=self.next_iuid(),
+                previous_iu=self._previous_ius.get(SequenceTracker.stream(frame)),
+                grounded_in=None,
+                # payload=message,
+            )
+            self.register_iu(frame, output_iu, None)
+
+        update_message.add_iu(output_iu, update_type)
+        with self.profiler.stage("append"):
+            self.append(update_message)
+
+    def process_reply(self, requester, frame, decoded=None):
+        """Transforms a reply to an AMQRequester's request into an IU of the requested type, and gives it to the
+        requester instead of appending it to the module's output.
+
+        Args:
+            requester (AMQRequester): the requester waiting for the reply.
+            frame (stomp.frame): the received ActiveMQ message.
+            decoded (concurrent.futures.Future): the body decoded by the decode pool, None to decode it now.
+        """
+        correlation_id = frame.headers["correlation-id"]
+        try:
+            msg_json = self.decode_body(frame, decoded)
+            reply_iu = self.create_iu_from_json(
+                frame, msg_json, iu_type=requester.reply_iu_type(correlation_id)
+            )
+        except Exception as e:
+            log_exception(module=self, exception=e)
+            self.metrics.inc(
+                "amq_decode_failures_total", destination=frame.headers["destination"]
+            )
+            requester.fail(correlation_id, e)
+            return
+        requester.resolve(correlation_id, reply_iu)
+
+    def create_iu_from_json(self, frame, msg_json, iu_type=None):
+        """Creates an IU of the destination's IU type from the JSON body sent by AMQWriter.
+        The IU's `previous_iu` and `grounded_in` are resolved from the producer's iuids sent in the message
+        (`previousRequestID` and `groundedInRequestID`), if the corresponding IUs were recently received. Otherwise, the
+        `previous_iu` is the last IU received from the same producer.
+        If the message is a request (`reply-to` header), the reply destination and correlation id are stored in the IU's
+        `meta_data`, so that an AMQBridge with `reply=True` can send the reply.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+            msg_json (dict): the decoded JSON of the IU.
+            iu_type (type): the type of the IU to create, None to use the destination's IU type.
+
+        Returns:
+            IncrementalUnit: the created IU.
+        """
+        destination = frame.headers["destination"]
+        with self.iu_lock:
+            previous_iu = self.iu_index.get(
+                msg_json.get("previousRequestID"), destination
+            )
+            if previous_iu is None:
+                previous_iu = self._previous_ius.get(SequenceTracker.stream(frame))
+            grounded_in = self.iu_index.get(
+                msg_json.get("groundedInRequestID"), destination
+            )
+        # create the decorated IU (cannot use classical create_iu from AbstractModule)
+        if iu_type is None:
+            iu_type = self.router.resolve(destination)
+        init_args = iu_type.__init__.__code__.co_varnames
+        common_args = msg_json.keys() & init_args
+        msg_json_filtered = {key: msg_json[key] for key in common_args}
+        with self.profiler.stage("create_iu"):
+            output_iu = iu_type(
+                creator=self,
+                iuid=self.next_iuid(),
+                previous_iu=previous_iu,
+                grounded_in=grounded_in,
+                **msg_json_filtered,
+            )
+        if "reply-to" in frame.headers:
+            if getattr(output_iu, "meta_data", None) is None:
+                output_iu.meta_data = dict()
+            output_iu.meta_data["amq_reply_to"] = frame.headers["reply-to"]
+            output_iu.meta_data["amq_correlation_id"] = frame.headers.get(
+                "correlation-id"
+            )
+        if self.print:
+            print(
+                "JSON MESSAGE RECEIVED: \n",
+                json.dumps(msg_json, indent=2),
+            )
+        with self.profiler.stage("log"):
+            self.terminal_logger.info(
+                "AMQReader creates new iu",
+                destination=destination,
+                ID=msg_json["requestID"],
+            )
+        self.register_iu(frame, output_iu, msg_json.get("requestID"))
+        return output_iu
+
+    def register_iu(self, frame, output_iu, request_id):
+        """Logs a created IU, and remembers it as the last IU of its producer and in the IU index.
+
+        Args:
+            frame (stomp.frame): the received ActiveMQ message.
+            output_iu (IncrementalUnit): the created IU.
+            request_id (str): the iuid of the IU on the producer's side.
+        """
+        with self.profiler.stage("log"):
+            self.terminal_logger.info(
+                "create_iu",
+                iuid=output_iu.iuid,
+                previous_iu=(
+                    output_iu.previous_iu.iuid
+                    if output_iu.previous_iu is not None
+                    else None
+                ),
+                grounded_in=(
+                    output_iu.grounded_in.iuid
+                    if output_iu.grounded_in is not None
+                    else None
+                ),
+            )
+        stream = SequenceTracker.stream(frame)
+        with self.iu_lock:
+            self._previous_iu = output_iu
+            self._previous_ius[stream] = output_iu
+            self._previous_ius.move_to_end(stream)
+            if len(self._previous_ius) > self.max_streams:
+                self._previous_ius.popitem(last=False)
+            self.iu_index.add(frame.headers["destination"], request_id, output_iu)
+
+    def next_iuid(self):
+        """Returns the iuid of a new IU."""
+        with self.iu_lock:
+            iuid = f"{hash(self)}:{self.iu_counter}"
+            self.iu_counter += 1
+        return iuid
+
 
 class AMQWriter(retico_core.AbstractModule):
     """
@@ -280,21 +1684,102 @@ class AMQWriter(retico_core.AbstractModule):
     def input_ius():
         return [AMQIU]
 
-    def __init__(self, ip, port, print=False, **kwargs):
+    def __init__(
+        self,
+        ip,
+        port,
+        print=False,
+        starvation_timeout=0.5,
+        default_qos="state",
+        envelope=False,
+        shm_threshold=65536,
+        shm_size=64 * 1024 * 1024,
+        shm_retention=5.0,
+        latency_budget=None,
+        max_batch=32,
+        max_linger=0.02,
+        profile=False,
+        max_streams=256,
+        **kwargs,
+    ):
         """Initializes the ActiveMQWriter.
 
         Args:
             ip (str): the IP of the computer.
             port (str): the port corresponding to ActiveMQ
             print (bool): boolean that manages printing
+            starvation_timeout (float): maximum time in seconds a message can wait in a lane while more urgent lanes are
+                sent.
+            default_qos (str or QoSProfile): the QoS profile of the destinations that have no profile.
+            envelope (bool): if True, all IUs of an update message sharing a destination are sent in a single message.
+            shm_threshold (int): size in characters from which the bodies sent to the destinations enabled with
+                `enable_shm` are written in shared memory.
+            shm_size (int): size in bytes of the shared memory segment.
+            shm_retention (float): minimum time in seconds a body is kept in shared memory.
+            latency_budget (float): latency budget in seconds of the destinations without budget, within which messages
+                are batched. None disables batching for these destinations.
+            max_batch (int): maximum number of messages sent in a single batch.
+            max_linger (float): maximum time in seconds to wait for more messages to batch.
+            profile (bool): True to record the wall and CPU time of each stage of the hot paths in the metrics.
+            max_streams (int): number of streams (destination, priority, message group) whose sequence is remembered,
+                the least recently used streams being restarted under a new stream id.
         """
         super().__init__(**kwargs)
         self.hosts = [(ip, port)]
         self.print = print
+        self.envelope = envelope
         self.conn = None
+        self.reconnect_lock = threading.Lock()
+        self.default_qos = get_qos_profile(default_qos)
+        self.qos_profiles = dict()
+        # by default, revocations (e.g. barge-in) overtake the other messages, but not the messages of their IU
+        self.priority_rules = [
+            (
+                PRIORITY_CONTROL,
+                None,
+                lambda iu, ut: ut == retico_core.UpdateType.REVOKE,
+            )
+        ]
+        self.queue = PriorityLanes(starvation_timeout=starvation_timeout)
+        self._tts_thread_active = False
+        self._thread = None
+        # stamped on every message, with a sequence number per (destination, priority, message group)
+        self.producer_id = uuid.uuid4().hex
+        # stream -> [stream id, next sequence number], least recently used first
+        self.sequences = OrderedDict()
+        self.max_streams = max_streams
+        self.stream_ids = itertools.count()
+        self.shm_destinations = set()
+        self.shm_threshold = shm_threshold
+        self.shm_size = shm_size
+        self.shm_retention = shm_retention
+        self.shm_ring = None
+        self.rate_limiters = dict()
+        # destination -> IU field giving the message group
+        self.group_by = dict()
+        self.batcher = AdaptiveBatchController(
+            latency_budget=latency_budget, max_batch=max_batch, max_linger=max_linger
+        )
+        self.metrics = AMQMetrics()
+        for lane in range(len(self.queue.lanes)):
+            self.metrics.register(
+                "amq_queue_depth",
+                lambda lane=lane: len(self.queue.lanes[lane]),
+                lane=lane,
+            )
+            self.metrics.register(
+                "amq_queue_mean_latency_seconds",
+                lambda lane=lane: self.queue.lane_stats()[lane]["mean_latency"],
+                lane=lane,
+            )
+        self.profiler = StageProfiler(self.metrics, enabled=profile)
 
     def setup(self):
         super().setup()
+        self.connect()
+
+    def connect(self):
+        """Connects to ActiveMQ."""
         try:
             self.conn = stomp.Connection(
                 host_and_ports=self.hosts, auto_content_length=False
@@ -304,58 +1789,516 @@ class AMQWriter(retico_core.AbstractModule):
             log_exception(module=self, exception=e)
             raise stomp.exception.ConnectFailedException from e
 
-    def process_update(self, update_message):
+    def prepare_run(self):
+        super().prepare_run()
+        self._tts_thread_active = True
+        self._thread = threading.Thread(target=self.run_writer)
+        self._thread.start()
+
+    def shutdown(self):
+        """The sending thread is joined, and the connection closed, so that no thread outlives the module."""
+        super().shutdown()
+        self._tts_thread_active = False
+        join_thread(self._thread)
+        self._thread = None
+        disconnect_stomp(self.conn)
+
+    def add_priority(self, lane, destination=None, predicate=None):
+        """Adds a rule classifying the sent messages into a priority lane. Rules are checked in insertion order, and
+        messages matching no rule go to the `PRIORITY_DEFAULT` lane.
+        The lane also sets the STOMP `priority` header of the message, so that the broker delivers it first.
+
+        Args:
+            lane (int): the lane of the matching messages (`PRIORITY_CONTROL`, `PRIORITY_DEFAULT` or `PRIORITY_BULK`).
+            destination (str): the ActiveMQ destination the rule applies to, None for all destinations.
+            predicate (Callable[[IncrementalUnit, UpdateType], bool]): function selecting the matching decorated IUs,
+                None for all IUs.
+        """
+        self.priority_rules.append((lane, destination, predicate))
+
+    def enable_shm(self, destination):
+        """Sends the large bodies of a destination through shared memory, only a small handle being sent through
+        ActiveMQ. All consumers of the destination must run on the same host as the writer.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+        """
+        self.shm_destinations.add(destination)
+
+    def to_shm(self, body, destination, headers):
+        """Writes a body in shared memory if its destination is enabled and it is large enough.
+
+        Returns:
+            str: the body to send through ActiveMQ, empty if the body was written in shared memory.
+        """
+        if destination not in self.shm_destinations or len(body) < self.shm_threshold:
+            return body
+        if self.shm_ring is None:
+            self.shm_ring = SharedMemoryRing(
+                size=self.shm_size, retention=self.shm_retention
+            )
+        handle = self.shm_ring.write(body.encode())
+        if handle is None:
+            # no free slot, the body is sent inline
+            self.metrics.inc("amq_shm_full_total", destination=destination)
+            return body
+        headers["amq-shm"] = handle
+        self.metrics.inc("amq_shm_messages_total", destination=destination)
+        return ""
+
+    def set_qos(self, destination, qos):
+        """Attaches a QoS profile to an ActiveMQ destination. A profile attached to an AMQIU (e.g. by its AMQBridge)
+        takes precedence over the destination's profile.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            qos (str or QoSProfile): a QoSProfile, or the name of a profile from `QOS_PROFILES`.
         """
-        The function will take all parameters from each decorated IU, and transform it into a json so that it can be sent to ActiveMQ.
+        self.qos_profiles[destination] = get_qos_profile(qos)
+
+    def iu_qos(self, amq_iu):
+        """Returns the QoS profile of an AMQIU.
+
+        Args:
+            amq_iu (AMQIU): the AMQIU to send.
+        """
+        if getattr(amq_iu, "qos", None) is not None:
+            return amq_iu.qos
+        return self.qos_profiles.get(amq_iu.destination, self.default_qos)
+
+    def iu_lane(self, amq_iu, update_type):
+        """Returns the priority lane of an AMQIU.
+
+        Args:
+            amq_iu (AMQIU): the AMQIU to send.
+            update_type (UpdateType): the update type of the AMQIU.
+        """
+        lane = match_priority_rules(
+            self.priority_rules,
+            amq_iu.destination,
+            amq_iu.get_deco_iu(),
+            update_type,
+        )
+        return PRIORITY_DEFAULT if lane is None else lane
+
+    def set_latency_budget(self, destination, budget):
+        """Batches the messages of a destination, tuning the batch size and linger to stay within a latency budget.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            budget (float): the latency budget in seconds, None disables batching for the destination.
+        """
+        self.batcher.set_budget(destination, budget)
+
+    def set_rate_limit(
+        self, destination, rate, burst=1, conflate=None, max_pending=100
+    ):
+        """Limits the number of messages sent per second to a destination. The messages above the limit wait until a
+        slot opens, and with conflation, only the newest ADD per value of an IU field is kept, the other updates of a
+        replaced IU being dropped with it. Envelopes, and the IUs without a value for the field, are not conflated.
+        The messages of the control lane are never limited.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            rate (float): number of messages sent per second, None removes the limit.
+            burst (int): maximum number of messages sent at once after an idle period.
+            conflate (str): the IU field the waiting ADDs are keyed on (e.g. `turnID`), None to keep all messages.
+            max_pending (int): maximum number of waiting messages, the oldest ones being dropped.
+        """
+        if rate is None:
+            self.rate_limiters.pop(destination, None)
+            return
+        limiter = RateLimiter(
+            rate, burst=burst, conflate=conflate, max_pending=max_pending
+        )
+        self.rate_limiters[destination] = limiter
+        self.metrics.register(
+            "amq_conflated_total",
+            lambda: limiter.nb_conflated,
+            "counter",
+            destination=destination,
+        )
+        self.metrics.register(
+            "amq_rate_limit_dropped_total",
+            lambda: limiter.nb_dropped,
+            "counter",
+            destination=destination,
+        )
+        self.metrics.register(
+            "amq_rate_limit_pending", lambda: len(limiter), destination=destination
+        )
+
+    def set_group_by(self, destination, field):
+        """Stamps the messages sent to a destination with a message group (`JMSXGroupID` header) taken from an IU field
+        (e.g. `turn_id`), so that ActiveMQ delivers all the messages of a group to the same competing consumer, which
+        processes them in order.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            field (str): the IU field giving the message group, None to stop grouping the messages.
+        """
+        if field is None:
+            self.group_by.pop(destination, None)
+        else:
+            self.group_by[destination] = field
+
+    def enqueue(self, body, destination, headers, lane, iu, update_type=None):
+        """Queues a message in its priority lane, or in its destination's rate limiter.
+
+        Args:
+            body (str): the body of the message.
+            destination (str): the ActiveMQ destination.
+            headers (dict): the headers of the message.
+            lane (int): the priority lane of the message.
+            iu (IncrementalUnit): the decorated IU of the message, None for an envelope.
+            update_type (UpdateType): the update type of the message, None for an envelope.
+        """
+        keys = self.ordering_keys(destination, headers)
+        ordered_lane = self.ordered_lane(destination, keys, lane)
+        if ordered_lane != lane:
+            lane = ordered_lane
+            headers["priority"] = STOMP_PRIORITIES[lane]
+            self.metrics.inc("amq_lane_demotions_total", destination=destination)
+        limiter = self.rate_limiters.get(destination)
+        if limiter is not None and lane != PRIORITY_CONTROL:
+            limiter.offer(
+                (body, destination, headers),
+                lane,
+                iu,
+                conflatable=update_type == retico_core.UpdateType.ADD,
+                keys=keys,
+            )
+        else:
+            self.queue.append(
+                (body, destination, headers, time.monotonic()), lane=lane, keys=keys
+            )
+
+    @staticmethod
+    def ordering_keys(destination, headers):
+        """Returns the ordering keys of a message : the (destination, iuid) of its IUs.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            headers (dict): the headers of the message.
+        """
+        return [(destination, iuid) for iuid in message_iuids(headers)]
+
+    def ordered_lane(self, destination, keys, lane):
+        """Returns the lane of a message, moved back to the lane of a waiting message of the same IUs if that lane is
+        less urgent, so that the updates of an IU are sent in order (e.g. a REVOKE doesn't overtake the ADD of its IU).
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            keys (list): the ordering keys of the message, from `ordering_keys`.
+            lane (int): the priority lane of the message.
+        """
+        if not keys:
+            return lane
+        waiting_lanes = [self.queue.last_lane(keys, lane)]
+        limiter = self.rate_limiters.get(destination)
+        if limiter is not None:
+            waiting_lanes.append(limiter.last_lane(keys, lane))
+        return max((l for l in waiting_lanes if l is not None), default=lane)
+
+    def release_limited(self):
+        """Moves the rate-limited messages that can be sent now to their priority lane.
+
+        Returns:
+            float: the time in seconds before the next rate-limited message can be sent, None if there is none.
+        """
+        next_release = None
+        for limiter in list(self.rate_limiters.values()):
+            for (body, destination, headers), lane in limiter.release():
+                self.queue.append(
+                    (body, destination, headers, time.monotonic()),
+                    lane=lane,
+                    keys=self.ordering_keys(destination, headers),
+                )
+            delay = limiter.next_release()
+            if delay is not None and (next_release is None or delay < next_release):
+                next_release = delay
+        return next_release
+
+    def run_writer(self):
+        """Function that will run on a separate thread and send the messages queued by `process_update` to ActiveMQ,
+        the most urgent priority lanes first.
+        """
+        while self._tts_thread_active:
+            try:
+                next_release = self.release_limited()
+                timeout = 0.2 if next_release is None else min(0.2, next_release)
+                message = self.queue.get(timeout=timeout)
+                if message is not None:
+                    self.send_batch(self.collect_batch(message))
+            except Exception as e:
+                log_exception(module=self, exception=e)
+                self.metrics.inc("amq_send_failures_total")
+                self.reconnect()
+        if self.shm_ring is not None:
+            self.shm_ring.close()
+            self.shm_ring = None
+
+    def collect_batch(self, message):
+        """Returns the batch of messages to send with `message` : the following messages of the same lane, destination
+        and message group, up to the destination's batch size, waiting at most the destination's linger for them.
+
+        Args:
+            message (tuple): the (body, destination, headers, enqueue time) of the first message.
+        """
+        destination, headers = message[1], message[2]
+        group = headers.get("JMSXGroupID")
+        state = self.batcher.state(destination)
+        if state is None or (state.batch_size <= 1 and state.linger == 0):
+            return [message]
+        lane = STOMP_PRIORITIES.index(headers["priority"])
+        deadline = time.monotonic() + state.linger
+        batch = [message]
+        while len(batch) < state.batch_size:
+            next_message = self.queue.pop_matching(
+                lane,
+                lambda m: m[1] == destination and m[2].get("JMSXGroupID") == group,
+                timeout=max(0.0, deadline - time.monotonic()),
+            )
+            if next_message is None:
+                break
+            batch.append(next_message)
+        return batch
+
+    @staticmethod
+    def merge_batch(batch):
+        """Merges several messages of the same destination into a single message (`amq-batch` header). Its body starts
+        with a JSON line giving the headers and the body length of each message, followed by the bodies of the messages,
+        concatenated without being encoded again. The batch is persistent if one of its messages is, and expires with
+        its last message.
+
+        Args:
+            batch (list): the (body, destination, headers, enqueue time) of the messages.
+
+        Returns:
+            tuple: the body and headers of the batch message.
+        """
+        headers = dict(batch[0][2])
+        headers.pop("amq-envelope", None)
+        # the update type is the one of each message, the batch carries the iuids of all its messages
+        headers.pop("update_type", None)
+        headers["amq-iuid"] = ",".join(
+            iuid for m in batch for iuid in message_iuids(m[2])
+        )
+        headers["amq-batch"] = str(len(batch))
+        if any(m[2].get("persistent") == "true" for m in batch):
+            headers["persistent"] = "true"
+        if all("expires" in m[2] for m in batch):
+            headers["expires"] = str(max(int(m[2]["expires"]) for m in batch))
+        else:
+            headers.pop("expires", None)
+        # the JSON index doesn't contain newlines, the bodies start after the first one
+        index = json.dumps([[m[2], len(m[0])] for m in batch])
+        body = "\n".join([index, "".join(m[0] for m in batch)])
+        return body, headers
+
+    def send_batch(self, batch):
+        """Sends a batch of messages of the same destination to ActiveMQ, as a single message if the batch contains
+        several messages, and gives the observed latency to the batch controller.
+
+        Args:
+            batch (list): the (body, destination, headers, enqueue time) of the messages.
+        """
+        destination = batch[0][1]
+        if len(batch) == 1:
+            body, headers = batch[0][0], batch[0][2]
+        else:
+            body, headers = self.merge_batch(batch)
+        # sequence numbers are given in sending order, as the lanes reorder the messages
+        stream = (destination, headers.get("priority"), headers.get("JMSXGroupID"))
+        sequence = self.sequences.get(stream)
+        if sequence is None:
+            # a new stream id, so that a restarted stream's numbers are not taken for duplicates by the readers
+            sequence = self.sequences[stream] = [next(self.stream_ids), 0]
+            if len(self.sequences) > self.max_streams:
+                self.sequences.popitem(last=False)
+        else:
+            self.sequences.move_to_end(stream)
+        headers["amq-producer"] = self.producer_id
+        headers["amq-stream"] = str(sequence[0])
+        headers["amq-seq"] = str(sequence[1])
+        sequence[1] += 1
+        body = self.to_shm(body, destination, headers)
+        start = time.monotonic()
+        with self.profiler.stage("send"):
+            self.conn.send(
+                body=body,
+                destination=destination,
+                headers=headers,
+            )
+        end = time.monotonic()
+        self.metrics.inc("amq_messages_sent_total", destination=destination)
+        self.metrics.inc("amq_bytes_sent_total", len(body), destination=destination)
+        if len(batch) > 1:
+            self.metrics.inc(
+                "amq_batched_messages_total", len(batch), destination=destination
+            )
+        state = self.batcher.state(destination)
+        if state is not None:
+            if state.nb_batches == 0:
+                self.register_batch_metrics(destination)
+            lane = STOMP_PRIORITIES.index(headers["priority"])
+            self.batcher.observe(
+                destination,
+                len(batch),
+                latency=start - min(m[3] for m in batch),
+                send_time=end - start,
+                backlog=len(self.queue.lanes[lane]),
+            )
+
+    def register_batch_metrics(self, destination):
+        """Registers the gauges of a destination's batch size and linger."""
+        self.metrics.register(
+            "amq_batch_size",
+            lambda: self.batcher.states[destination].batch_size,
+            destination=destination,
+        )
+        self.metrics.register(
+            "amq_batch_linger_seconds",
+            lambda: self.batcher.states[destination].linger,
+            destination=destination,
+        )
+
+    def reconnect(self):
+        """Reconnects to ActiveMQ if the connection was lost, retrying until it succeeds or the module stops. The
+        queued messages wait for the connection.
+        """
+        if self.conn is None or self.conn.is_connected():
+            return
+        reconnect_with_backoff(self, self, lambda: self._tts_thread_active)
+
+    def iu_to_json(self, decorated_iu):
+        """
+        The function will take all parameters from a decorated IU, and transform it into a dict that can be transformed into a json.
         Some IU parameters are blacklisted (`black_listed_keys`), they either can't be transformed into json, or are useless outside of the retico system.
+
+        Args:
+            decorated_iu (IncrementalUnit): the IU to send.
         """
+        # if we want all iu info
+        # body = json.dumps(decorated_iu.__dict__)
+        # if we want all iu info except some
+        black_listed_keys = {
+            "creator",
+            "previous_iu",
+            "grounded_in",
+            "_processed_list",
+            "mutex",
+            "committed",
+            "revoked",
+            "meta_data",
+            "iuid",
+        }
+        iu_info = decorated_iu.__dict__
+        iu_info_filtered = {
+            key: iu_info[key] for key in iu_info.keys() - black_listed_keys
+        }
+        iu_info_filtered["requestID"] = iu_info["iuid"]
+        # the links to other IUs are sent as iuids, resolved by AMQReader
+        if decorated_iu.previous_iu is not None:
+            iu_info_filtered["previousRequestID"] = decorated_iu.previous_iu.iuid
+        if decorated_iu.grounded_in is not None:
+            iu_info_filtered["groundedInRequestID"] = decorated_iu.grounded_in.iuid
+        return iu_info_filtered
+
+    def message_headers(self, amq_iu, lane):
+        """Returns the headers of the message sending an AMQIU : the AMQIU's headers, the priority, the QoS headers
+        and the message group.
 
-        for amq_iu, _ in update_message:
+        Args:
+            amq_iu (AMQIU): the AMQIU to send.
+            lane (int): the priority lane of the message.
+        """
+        headers = dict(amq_iu.headers) if amq_iu.headers is not None else {}
+        headers["priority"] = STOMP_PRIORITIES[lane]
+        headers.update(self.iu_qos(amq_iu).headers())
+        field = self.group_by.get(amq_iu.destination)
+        if field is not None:
+            group = getattr(amq_iu.get_deco_iu(), field, None)
+            if group is not None:
+                headers["JMSXGroupID"] = str(group)
+        return headers
+
+    def process_update(self, update_message):
+        """
+        The function will transform each decorated IU into a json so that it can be sent to ActiveMQ.
+        The messages are queued in the priority lane of the IU, and sent by `run_writer`.
+        In envelope mode, all IUs of the update message sharing a destination are sent in a single message.
+        """
+        if self.envelope:
+            return self.process_update_envelope(update_message)
+
+        for amq_iu, ut in update_message:
 
             # create a JSON from all decorated IU extracted information
             decorated_iu = amq_iu.get_deco_iu()
-
-            # if we want all iu info
-            # body = json.dumps(decorated_iu.__dict__)
-            # if we want all iu info except some
-            black_listed_keys = {
-                "creator",
-                "previous_iu",
-                "grounded_in",
-                "_processed_list",
-                "mutex",
-                "committed",
-                "revoked",
-                "meta_data",
-                "iuid",
-            }
-            iu_info = decorated_iu.__dict__
-            iu_info_filtered = {
-                key: iu_info[key] for key in iu_info.keys() - black_listed_keys
-            }
-            iu_info_filtered["requestID"] = iu_info["iuid"]
-            body = json.dumps(iu_info_filtered, indent=2)
+            with self.profiler.stage("serialize"):
+                iu_info_filtered = self.iu_to_json(decorated_iu)
+                body = json.dumps(iu_info_filtered, indent=2)
             # if you have a to_amq() function in IU class
             # body = decorated_iu.to_amq()
             # # if we just want to send the payload
             # body = decorated_iu.payload
 
             # send the message to the correct destination
+            with self.profiler.stage("log"):
+                self.terminal_logger.info(
+                    "AMQWriter sends a message to ActiveMQ",
+                    destination=amq_iu.destination,
+                    ID=decorated_iu.iuid,
+                    # headers=amq_iu.headers,
+                    # body=body,
+                )
+            if self.print:
+                print("JSON MESSAGE SENT: \n", body)
+            lane = self.iu_lane(amq_iu, ut)
+            headers = self.message_headers(amq_iu, lane)
+            headers["update_type"] = ut.value
+            headers["amq-iuid"] = str(decorated_iu.iuid)
+            with self.profiler.stage("enqueue"):
+                self.enqueue(body, amq_iu.destination, headers, lane, decorated_iu, ut)
+
+        return None
+
+    def process_update_envelope(self, update_message):
+        """Sends all IUs of the update message sharing a destination, with their update types, in a single envelope
+        message (`amq-envelope` header), that AMQReader transforms back into a single UpdateMessage.
+        The envelope takes the headers and QoS of its first IU, and the most urgent lane of its IUs.
+        """
+        envelopes = dict()
+        for amq_iu, ut in update_message:
+            entries, lane, first_iu = envelopes.get(
+                amq_iu.destination, ([], PRIORITY_BULK, amq_iu)
+            )
+            entries.append(
+                {
+                    "update_type": ut.value,
+                    "iu": self.iu_to_json(amq_iu.get_deco_iu()),
+                }
+            )
+            lane = min(lane, self.iu_lane(amq_iu, ut))
+            envelopes[amq_iu.destination] = (entries, lane, first_iu)
+
+        for destination, (entries, lane, first_iu) in envelopes.items():
+            with self.profiler.stage("serialize"):
+                body = json.dumps({"envelope": entries})
             self.terminal_logger.info(
-                "AMQWriter sends a message to ActiveMQ",
-                destination=amq_iu.destination,
-                ID=iu_info["iuid"],
-                # headers=amq_iu.headers,
-                # body=body,
+                "AMQWriter sends an envelope to ActiveMQ",
+                destination=destination,
+                IDs=[entry["iu"]["requestID"] for entry in entries],
             )
             if self.print:
                 print("JSON MESSAGE SENT: \n", body)
-            self.conn.send(
-                body=body,
-                destination=amq_iu.destination,
-                headers=amq_iu.headers,
-                persistent=True,
+            headers = self.message_headers(first_iu, lane)
+            headers["amq-envelope"] = "1"
+            headers["amq-iuid"] = ",".join(
+                str(entry["iu"]["requestID"]) for entry in entries
             )
+            self.enqueue(body, destination, headers, lane, None)
 
         return None
 
@@ -381,20 +2324,58 @@ class AMQBridge(retico_core.AbstractModule):
     def input_ius():
         return [IncrementalUnit]
 
-    def __init__(self, headers, destination, **kwargs):
+    def __init__(
+        self, headers, destination, qos=None, reply=False, profile=False, **kwargs
+    ):
         """Initializes the AMQBridge.
 
         Args:
             headers (dict): the ActiveMQ headers to be sent with the message.
             destination (str): the ActiveMQ destination to send the message to.
+            qos (str or QoSProfile): the QoS profile of the messages, None to use the AMQWriter's profile of the
+                destination.
+            reply (bool): if True, the IUs grounded in a request received by an AMQReader are sent as replies to this
+                request (to its `reply-to` destination, with its `correlation-id`), instead of to `destination`.
+            profile (bool): True to record the wall and CPU time of the AMQIUs creation in the metrics.
         """
         super().__init__(**kwargs)
-        self.headers = headers
-        self.destination = destination
+        # shared by all the AMQIUs created by the bridge
+        self.headers = MappingProxyType(dict(headers)) if headers is not None else None
+        self.destination = sys.intern(destination) if destination is not None else None
+        self.qos = get_qos_profile(qos)
+        self.reply = reply
+        self.metrics = AMQMetrics()
+        self.profiler = StageProfiler(self.metrics, enabled=profile)
+
+    @staticmethod
+    def reply_info(iu):
+        """Returns the reply destination and correlation id of the request an IU is grounded in, None if the IU is not
+        grounded in a request.
+
+        Args:
+            iu (IncrementalUnit): the IU to send.
+        """
+        while iu is not None:
+            meta_data = getattr(iu, "meta_data", None)
+            if meta_data and "amq_reply_to" in meta_data:
+                return meta_data["amq_reply_to"], meta_data["amq_correlation_id"]
+            iu = iu.grounded_in
+        return None
+
+    def output_destination(self, input_iu):
+        """Returns the destination and headers of the AMQIU decorating `input_iu`."""
+        reply_info = self.reply_info(input_iu) if self.reply else None
+        if reply_info is None:
+            return self.destination, self.headers
+        reply_to, correlation_id = reply_info
+        headers = dict(self.headers) if self.headers is not None else {}
+        headers["correlation-id"] = correlation_id
+        return reply_to, headers
 
     def process_update(self, update_message):
         """Transform an IU into an AMQIU.
         For now : except the `final` IUs which are empty
+        The AMQIUs are CompactAMQIUs, that are not chained to the previously created AMQIUs.
         """
         um = retico_core.abstract.UpdateMessage()
 
@@ -404,23 +2385,32 @@ class AMQBridge(retico_core.AbstractModule):
                     self.terminal_logger.warning("IU IS FINAL")
                 else:
                     # create AMQIU
-                    output_iu = self.create_iu(
-                        decorated_iu=input_iu,
-                        destination=self.destination,
-                        headers=self.headers,
-                    )
-                    um.add_iu(output_iu, ut)
+                    um.add_iu(self.create_amq_iu(input_iu), ut)
             else:
                 # create AMQIU
-                output_iu = self.create_iu(
-                    decorated_iu=input_iu,
-                    destination=self.destination,
-                    headers=self.headers,
-                )
-                um.add_iu(output_iu, ut)
+                um.add_iu(self.create_amq_iu(input_iu), ut)
 
         return um
 
+    def create_amq_iu(self, input_iu):
+        """Creates the CompactAMQIU decorating `input_iu`.
+
+        Args:
+            input_iu (IncrementalUnit): the IU to send.
+        """
+        destination, headers = self.output_destination(input_iu)
+        with self.profiler.stage("create_iu"):
+            output_iu = CompactAMQIU(
+                self,
+                f"{hash(self)}:{self.iu_counter}",
+                input_iu,
+                headers,
+                destination,
+                self.qos,
+            )
+            self.iu_counter += 1
+        return output_iu
+
 
 ## The retico-zmq implementation method
 
@@ -0,0 +1,135 @@
+"""
+AMQ Adaptive Batching
+=====================
+
+This module defines AdaptiveBatchController, that tunes the batching of AMQWriter's messages per destination : how
+many queued messages are sent in a single ActiveMQ message (batch size), and how long the writer waits for more
+messages before sending an incomplete batch (linger).
+The controller measures, for each sent batch, the enqueue-to-send latency of its messages and the broker send time,
+and adapts the batch size and linger to stay within the destination's latency budget :
+    - latency above the budget : the batch size and linger are halved,
+    - messages still waiting and latency below half of the budget : the batch size grows by 1, and the linger grows
+      within the remaining latency headroom,
+    - no message waiting : the linger decreases, as waiting only adds latency on a quiet link.
+Every change is recorded with its reason, so that operators can see why the writer is batching.
+"""
+
+import time
+from collections import deque
+
+
+class BatchState:
+    """Batching parameters and last observations of a destination."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.batch_size = 1
+        self.linger = 0.0
+        self.latency = 0.0
+        self.send_time = 0.0
+        self.nb_batches = 0
+
+    def to_dict(self):
+        return {
+            "budget": self.budget,
+            "batch_size": self.batch_size,
+            "linger": self.linger,
+            "latency": self.latency,
+            "send_time": self.send_time,
+            "batches": self.nb_batches,
+        }
+
+
+class AdaptiveBatchController:
+    """Per-destination controller of the batch size and linger of AMQWriter, driven by the observed latency."""
+
+    def __init__(self, latency_budget=None, max_batch=32, max_linger=0.02, history=100):
+        """Initializes the AdaptiveBatchController.
+
+        Args:
+            latency_budget (float): default latency budget in seconds, None disables batching for the destinations
+                without budget.
+            max_batch (int): maximum number of messages in a batch.
+            max_linger (float): maximum time in seconds to wait for more messages.
+            history (int): number of decisions kept.
+        """
+        self.latency_budget = latency_budget
+        self.max_batch = max_batch
+        self.max_linger = max_linger
+        self.budgets = dict()
+        self.states = dict()
+        self.decisions = deque(maxlen=history)
+
+    def set_budget(self, destination, budget):
+        """Sets the latency budget of a destination, None disables its batching.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            budget (float): the latency budget in seconds.
+        """
+        self.budgets[destination] = budget
+        self.states.pop(destination, None)
+
+    def state(self, destination):
+        """Returns the BatchState of a destination, None if its batching is disabled."""
+        state = self.states.get(destination)
+        if state is None:
+            budget = self.budgets.get(destination, self.latency_budget)
+            if budget is None:
+                return None
+            state = self.states[destination] = BatchState(budget)
+        return state
+
+    def observe(self, destination, batch_len, latency, send_time, backlog):
+        """Adapts the batching parameters of a destination after a batch was sent.
+
+        Args:
+            destination (str): the ActiveMQ destination.
+            batch_len (int): number of messages in the batch.
+            latency (float): maximum enqueue-to-send latency of the batch's messages, in seconds.
+            send_time (float): time spent sending the batch to ActiveMQ, in seconds.
+            backlog (int): number of messages still waiting to be sent.
+        """
+        state = self.state(destination)
+        if state is None:
+            return
+        state.latency = latency
+        state.send_time = send_time
+        state.nb_batches += 1
+        batch_size, linger = state.batch_size, state.linger
+        if latency > state.budget:
+            state.batch_size = max(1, state.batch_size // 2)
+            state.linger = state.linger / 2
+            reason = f"latency {latency:.4f}s above budget {state.budget:.4f}s"
+        elif backlog > 0 and latency < state.budget / 2:
+            state.batch_size = min(self.max_batch, state.batch_size + 1)
+            headroom = max(0.0, state.budget / 2 - send_time)
+            state.linger = min(self.max_linger, headroom, state.linger + headroom / 4)
+            reason = (
+                f"{backlog} messages waiting, latency {latency:.4f}s below half budget"
+            )
+        elif backlog == 0 and batch_len < state.batch_size:
+            state.linger = state.linger / 2 if state.linger > 1e-4 else 0.0
+            reason = "quiet link, incomplete batch"
+        else:
+            return
+        if (batch_size, linger) != (state.batch_size, state.linger):
+            self.decisions.append(
+                {
+                    "time": time.time(),
+                    "destination": destination,
+                    "batch_size": state.batch_size,
+                    "linger": state.linger,
+                    "reason": reason,
+                }
+            )
+
+    def report(self):
+        """Returns the batching parameters and last observations of each destination, and the recent decisions."""
+        return {
+            "destinations": {
+                destination: state.to_dict()
+                for destination, state in self.states.items()
+            },
+            "decisions": list(self.decisions),
+        }
@@ -0,0 +1,63 @@
+"""
+AMQ Lane Index
+==============
+
+This module defines LaneIndex, that counts the waiting messages of a priority queue per ordering key (e.g. an iuid or
+a producer stream) and lane, so that the least urgent lane holding a message with one of some keys is found without
+scanning the waiting messages.
+"""
+
+
+class LaneIndex:
+    """Number of waiting messages per key and lane. It is not thread-safe, and is updated under the lock of its queue."""
+
+    def __init__(self):
+        # key -> {lane : number of waiting messages}
+        self.counts = dict()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, keys, lane):
+        """Counts a message added to a lane.
+
+        Args:
+            keys (Iterable): the distinct ordering keys of the message.
+            lane (int): the lane of the message.
+        """
+        for key in keys:
+            lanes = self.counts.setdefault(key, dict())
+            lanes[lane] = lanes.get(lane, 0) + 1
+
+    def remove(self, keys, lane):
+        """Uncounts a message removed from a lane.
+
+        Args:
+            keys (Iterable): the distinct ordering keys of the message, as given to `add`.
+            lane (int): the lane of the message.
+        """
+        for key in keys:
+            lanes = self.counts[key]
+            if lanes[lane] > 1:
+                lanes[lane] -= 1
+                continue
+            del lanes[lane]
+            if not lanes:
+                del self.counts[key]
+
+    def last_lane(self, keys, lane=0):
+        """Returns the least urgent lane after `lane` holding a message with one of the keys, None if there is none.
+
+        Args:
+            keys (Iterable): the ordering keys to look for.
+            lane (int): the lane the search stops at, excluded.
+        """
+        return max(
+            (
+                waiting_lane
+                for key in keys
+                for waiting_lane in self.counts.get(key, ())
+                if waiting_lane > lane
+            ),
+            default=None,
+        )
@@ -0,0 +1,163 @@
+"""
+AMQ Metrics
+===========
+
+This module defines the metrics kept by the AMQ modules (messages and bytes per destination, queue depth, failures,
+reconnections, ...), that can be pulled with `AMQMetrics.snapshot`, or exposed in Prometheus text format on a local HTTP
+endpoint started with `start_metrics_server`.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class AMQMetrics:
+    """Counters and gauges of an AMQ module.
+    Counters are lock-free : each thread increments its own shard, and the shards are summed when the metrics are
+    collected. Gauges are functions called when the metrics are collected, so they cost nothing on the hot paths.
+    """
+
+    def __init__(self):
+        # list of the per-thread counters dicts, (name, labels) -> value
+        self._shards = []
+        self._local = threading.local()
+        # (name, labels) -> (function, kind)
+        self._callbacks = dict()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        """Increments a counter.
+
+        Args:
+            name (str): the name of the counter.
+            value (int): the increment.
+            labels: the labels of the counter (e.g. destination).
+        """
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = dict()
+            self._shards.append(shard)
+        key = self._key(name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def register(self, name, function, kind="gauge", **labels):
+        """Registers a metric whose value is given by a function called at collection time.
+
+        Args:
+            name (str): the name of the metric.
+            function (Callable[[], float]): the function returning the metric's value.
+            kind (str): "gauge", or "counter" if the value can only increase.
+            labels: the labels of the metric.
+        """
+        self._callbacks[self._key(name, labels)] = (function, kind)
+
+    def collect(self):
+        """Returns the list of all metrics, as (name, labels, kind, value) tuples."""
+        counters = dict()
+        for shard in list(self._shards):
+            for key, value in shard.copy().items():
+                counters[key] = counters.get(key, 0) + value
+        metrics = [
+            (name, labels, "counter", value)
+            for (name, labels), value in counters.items()
+        ]
+        for (name, labels), (function, kind) in list(self._callbacks.items()):
+            try:
+                metrics.append((name, labels, kind, function()))
+            except Exception:
+                continue
+        return metrics
+
+    def snapshot(self):
+        """Returns all metrics as a dict, mapping `name{label="value",...}` to the metric's value."""
+        return {
+            format_metric_name(name, labels): value
+            for name, labels, _, value in self.collect()
+        }
+
+    def value(self, name, **labels):
+        """Returns the value of a metric, 0 if it has never been incremented."""
+        key = self._key(name, labels)
+        for metric_name, metric_labels, _, value in self.collect():
+            if (metric_name, metric_labels) == key:
+                return value
+        return 0
+
+    def to_prometheus(self, **extra_labels):
+        """Returns the metrics in Prometheus text exposition format.
+
+        Args:
+            extra_labels: labels added to all metrics (e.g. module).
+        """
+        return format_prometheus(self.collect(), extra_labels)
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_metric_name(name, labels):
+    """Returns the Prometheus representation `name{label="value",...}` of a metric."""
+    if not labels:
+        return name
+    labels = ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels)
+    return f"{name}{{{labels}}}"
+
+
+def format_prometheus(metrics, extra_labels=None):
+    """Formats a list of (name, labels, kind, value) metrics in Prometheus text exposition format.
+
+    Args:
+        metrics (list): the metrics, as returned by `AMQMetrics.collect`.
+        extra_labels (dict): labels added to all metrics.
+    """
+    extra_labels = tuple(sorted((extra_labels or {}).items()))
+    lines = []
+    typed = set()
+    for name, labels, kind, value in sorted(metrics, key=lambda m: (m[0], m[1])):
+        if name not in typed:
+            lines.append(f"# TYPE {name} {kind}")
+            typed.add(name)
+        lines.append(f"{format_metric_name(name, extra_labels + labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(modules, port=9108, host="127.0.0.1"):
+    """Starts a local HTTP server exposing the metrics of AMQ modules in Prometheus text format on `/metrics`.
+
+    Args:
+        modules (list): the modules with a `metrics` attribute (AMQReader, AMQWriter, ...).
+        port (int): the port of the HTTP server.
+        host (str): the interface of the HTTP server, localhost by default.
+
+    Returns:
+        ThreadingHTTPServer: the running server, stop it with its `shutdown` method.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            metrics = []
+            for module in modules:
+                metrics.extend(
+                    (name, (("module", module.name()),) + labels, kind, value)
+                    for name, labels, kind, value in module.metrics.collect()
+                )
+            body = format_prometheus(metrics).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
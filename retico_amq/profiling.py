@@ -0,0 +1,238 @@
+"""
+AMQ Profiling
+=============
+
+This module defines StageProfiler, the opt-in profiling of the AMQ modules' hot paths. Each hot path is split in
+stages (stomp I/O, JSON, IU construction, logging, `append`, ...), and the profiler records the number of calls, the
+wall time and the CPU time of each stage in the module's metrics.
+At runtime, a timed capture can also be triggered and dumped to a file, without restarting the network :
+    - "cprofile" : the module's stages are profiled with cProfile, the file can be read with `pstats`. From Python 3.12,
+      a single profiler can be active in the process, and it profiles all threads : the capture then profiles the whole
+      process during its duration,
+    - "sampling" : the stacks of all threads are sampled at a fixed interval, the file contains one collapsed stack
+      per line with its number of samples (flame graph format).
+When profiling is disabled and no capture is running, a stage costs a single attribute check.
+"""
+
+import contextlib
+import cProfile
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# from Python 3.12, cProfile uses sys.monitoring : only one profiler can be active, for all the threads of the process
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+
+class _Stage:
+    """Context manager measuring the wall and CPU time of a stage."""
+
+    __slots__ = ("profiler", "name", "capture", "wall", "cpu")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.capture = profiler.capture
+
+    def __enter__(self):
+        if self.capture is not None and not self.capture.enter():
+            self.capture = None
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        if self.capture is not None:
+            self.capture.exit()
+        if self.profiler.enabled:
+            metrics = self.profiler.metrics
+            metrics.inc("amq_stage_calls_total", stage=self.name)
+            metrics.inc("amq_stage_wall_seconds_total", wall, stage=self.name)
+            metrics.inc("amq_stage_cpu_seconds_total", cpu, stage=self.name)
+        return False
+
+
+class _ProfileCapture:
+    """cProfile capture of the stages, with one profile per thread, or a single profile of the whole process where only
+    one profiler can be active (`process_wide`).
+    """
+
+    def __init__(self, process_wide=PROCESS_WIDE_PROFILER):
+        self.local = threading.local()
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.running = True
+        self.process_wide = process_wide
+        if process_wide:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                raise RuntimeError(
+                    "another profiler is active in the process, use the 'sampling' mode"
+                ) from e
+            self.profiles.append(profile)
+
+    def enter(self):
+        """Starts profiling a stage in the calling thread.
+
+        Returns:
+            bool: True if `exit` has to be called at the end of the stage.
+        """
+        if self.process_wide:
+            return False
+        depth = getattr(self.local, "depth", 0)
+        if depth == 0:
+            if not self.running:
+                return False
+            profile = getattr(self.local, "profile", None)
+            if profile is None:
+                profile = self.local.profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is active, the stage is not profiled
+                return False
+            with self.lock:
+                if profile not in self.profiles:
+                    self.profiles.append(profile)
+                self.active += 1
+        self.local.depth = depth + 1
+        return True
+
+    def exit(self):
+        self.local.depth -= 1
+        profile = getattr(self.local, "profile", None)
+        if self.local.depth > 0 or profile is None:
+            return
+        profile.disable()
+        with self.lock:
+            self.active = max(0, self.active - 1)
+
+    def dump(self, path, timeout=1.0):
+        """Stops the capture, waits for the stages being profiled to end, and dumps the merged profiles."""
+        self.running = False
+        if self.process_wide:
+            self.profiles[0].disable()
+        deadline = time.monotonic() + timeout
+        while self.active > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return False
+        pstats.Stats(*profiles).dump_stats(path)
+        return True
+
+
+def sample_stacks(duration, path, interval=0.005):
+    """Samples the stacks of all threads during `duration` seconds, and writes them to `path` in collapsed stack
+    format (`frame;frame;frame count` per line).
+
+    Args:
+        duration (float): the duration of the capture in seconds.
+        path (str): the file to write.
+        interval (float): the sampling interval in seconds.
+    """
+    current = threading.get_ident()
+    stacks = Counter()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    with open(path, "w") as f:
+        for stack, nb_samples in stacks.most_common():
+            f.write(f"{stack} {nb_samples}\n")
+
+
+class StageProfiler:
+    """Per-stage wall / CPU time recording of a module's hot paths, and runtime captures."""
+
+    def __init__(self, metrics, enabled=False):
+        """Initializes the StageProfiler.
+
+        Args:
+            metrics (AMQMetrics): the module's metrics, where the stages' times are recorded.
+            enabled (bool): True to record the stages' times.
+        """
+        self.metrics = metrics
+        self.enabled = enabled
+        self.capture = None
+
+    def stage(self, name):
+        """Returns the context manager profiling a stage.
+
+        Args:
+            name (str): the name of the stage.
+        """
+        if not self.enabled and self.capture is None:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def report(self):
+        """Returns, for each stage, the number of calls, and the total and mean wall and CPU times in seconds."""
+        report = dict()
+        for name, labels, _, value in self.metrics.collect():
+            if not name.startswith("amq_stage_"):
+                continue
+            stage = dict(labels)["stage"]
+            key = name[len("amq_stage_") : -len("_total")]
+            report.setdefault(stage, dict())[key] = value
+        for stats in report.values():
+            calls = stats.get("calls", 0)
+            stats["mean_wall_seconds"] = (
+                stats.get("wall_seconds", 0) / calls if calls else 0
+            )
+            stats["mean_cpu_seconds"] = (
+                stats.get("cpu_seconds", 0) / calls if calls else 0
+            )
+        return report
+
+    def start_capture(self, duration, path, mode="cprofile", interval=0.005):
+        """Starts a timed capture, dumped to a file when it ends.
+
+        Args:
+            duration (float): the duration of the capture in seconds.
+            path (str): the file to write.
+            mode (str): "cprofile" to profile the module's stages, "sampling" to sample the stacks of all threads.
+            interval (float): the sampling interval in seconds, in "sampling" mode.
+
+        Returns:
+            threading.Thread: the thread running the capture, join it to wait for the file.
+        """
+        if mode == "sampling":
+            target, args = sample_stacks, (duration, path, interval)
+        elif mode == "cprofile":
+            if self.capture is not None:
+                raise RuntimeError("a cProfile capture is already running")
+            capture = self.capture = _ProfileCapture()
+            if capture.process_wide:
+                # the stages don't have to enable the profiler
+                self.capture = None
+
+            def target():
+                time.sleep(duration)
+                self.capture = None
+                capture.dump(path)
+
+            args = ()
+        else:
+            raise ValueError(f"mode should be 'cprofile' or 'sampling', not {mode}")
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
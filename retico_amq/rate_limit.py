@@ -0,0 +1,132 @@
+"""
+AMQ Rate Limiting
+=================
+
+This module defines RateLimiter, a per-destination token bucket holding AMQWriter's messages until they can be sent.
+With conflation, the pending ADD messages are keyed on an IU field (e.g. `turnID`), and a new ADD replaces the pending
+ADD with the same key, so that only the newest value is sent when a slot opens. The other pending messages of the
+replaced IU are dropped with it, as well as its later updates (the iuids of the recently replaced IUs are remembered),
+and the other update types are never conflated, so that no update refers to an IU that was not sent.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+from retico_amq.lanes import LaneIndex
+
+
+class RateLimiter:
+    """Token bucket of a destination, with optional latest-value conflation of the pending messages."""
+
+    def __init__(
+        self, rate, burst=1, conflate=None, max_pending=100, max_replaced=1024
+    ):
+        """Initializes the RateLimiter.
+
+        Args:
+            rate (float): number of messages sent per second.
+            burst (int): maximum number of messages sent at once after an idle period.
+            conflate (str): the IU field the pending ADD messages are keyed on, None to keep all messages.
+            max_pending (int): maximum number of pending messages, the oldest ones being dropped.
+            max_replaced (int): number of replaced IUs remembered, whose later updates are dropped.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.conflate = conflate
+        self.max_pending = max_pending
+        self.max_replaced = max_replaced
+        self.tokens = burst
+        self.last = time.monotonic()
+        # key -> (message, lane, IU, ordering keys)
+        self.pending = OrderedDict()
+        self.index = LaneIndex()
+        # iuids of the IUs replaced by a newer ADD before being sent, oldest first
+        self.replaced_iuids = OrderedDict()
+        self.lock = threading.Lock()
+        self.counter = count()
+        self.nb_conflated = 0
+        self.nb_dropped = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def offer(self, message, lane, iu, conflatable=True, keys=()):
+        """Adds a message to the pending messages, replacing the pending ADD with the same conflation key.
+
+        Args:
+            message (tuple): the message to send.
+            lane (int): the priority lane of the message.
+            iu (IncrementalUnit): the decorated IU of the message, giving the conflation key, None for an envelope.
+            conflatable (bool): True for an ADD message, the only messages that can be conflated.
+            keys (Collection): the distinct ordering keys of the message, looked up by `last_lane`.
+        """
+        value = None
+        if self.conflate is not None and conflatable:
+            value = getattr(iu, self.conflate, None)
+        # an IU without conflation key is never conflated
+        key = ("unique", next(self.counter)) if value is None else ("conflate", value)
+        with self.lock:
+            if iu is not None and not conflatable and iu.iuid in self.replaced_iuids:
+                # the IU was replaced before being sent, its updates are never sent either
+                self.nb_conflated += 1
+                return
+            if key in self.pending:
+                # the newest value keeps the position of the oldest, so it is not delayed
+                self.nb_conflated += 1
+                _, replaced_lane, replaced_iu, replaced_keys = self.pending[key]
+                self.index.remove(replaced_keys, replaced_lane)
+                if replaced_iu is not iu:
+                    # the replaced IU is never sent, neither are its other updates
+                    self.replaced_iuids[replaced_iu.iuid] = None
+                    if len(self.replaced_iuids) > self.max_replaced:
+                        self.replaced_iuids.popitem(last=False)
+                    for other_key in [
+                        other_key
+                        for other_key, (_, _, pending_iu, _) in self.pending.items()
+                        if pending_iu is replaced_iu and other_key != key
+                    ]:
+                        self._remove(other_key)
+                        self.nb_conflated += 1
+            elif len(self.pending) >= self.max_pending:
+                self._remove(next(iter(self.pending)))
+                self.nb_dropped += 1
+            self.pending[key] = (message, lane, iu, keys)
+            self.index.add(keys, lane)
+
+    def last_lane(self, keys, lane=0):
+        """Returns the least urgent lane after `lane` of a pending message with one of the ordering keys, None if there
+        is none.
+
+        Args:
+            keys (Iterable): the ordering keys to look for.
+            lane (int): the lane the search stops at, excluded.
+        """
+        with self.lock:
+            return self.index.last_lane(keys, lane)
+
+    def _remove(self, key):
+        message, lane, _, keys = self.pending.pop(key)
+        self.index.remove(keys, lane)
+        return message, lane
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def release(self):
+        """Removes and returns the pending messages that can be sent now, as (message, lane) tuples."""
+        released = []
+        with self.lock:
+            self._refill(time.monotonic())
+            while self.pending and self.tokens >= 1:
+                self.tokens -= 1
+                released.append(self._remove(next(iter(self.pending))))
+        return released
+
+    def next_release(self):
+        """Returns the time in seconds before the next pending message can be sent, None if there is none."""
+        if not self.pending:
+            return None
+        return max(0.0, (1 - self.tokens) / self.rate)
@@ -0,0 +1,169 @@
+"""
+AMQ Request / Reply
+===================
+
+This module defines AMQRequester, a helper sending an IU as a request to a remote service through ActiveMQ, and
+returning the service's reply as an IU, through a future.
+
+The request is sent with a `reply-to` header (a temporary queue of the AMQReader's connection) and a `correlation-id`
+header. On the service's side, the AMQReader stores them in the `meta_data` of the created IU, and an AMQBridge with
+`reply=True` sends the IUs grounded in this request back to the `reply-to` destination, with the same
+`correlation-id`.
+"""
+
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from retico_amq.amq import PRIORITY_CONTROL, STOMP_PRIORITIES
+
+
+class AMQRequester:
+    """Sends requests through an AMQReader's connection, and resolves the futures of the pending requests when the
+    AMQReader receives their replies.
+    The number of requests waiting for a reply is bounded by `max_in_flight`, and a request without reply after its
+    timeout fails with a TimeoutError.
+    """
+
+    def __init__(
+        self, reader, writer, max_in_flight=8, timeout=1.0, reply_destination=None
+    ):
+        """Initializes the AMQRequester.
+
+        Args:
+            reader (AMQReader): the reader whose connection sends the requests and receives the replies.
+            writer (AMQWriter): the writer used to serialize the request IUs.
+            max_in_flight (int): maximum number of requests waiting for a reply.
+            timeout (float): default time in seconds to wait for a reply.
+            reply_destination (str): the destination of the replies, a new temporary queue by default.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.reply_destination = (
+            reply_destination
+            if reply_destination is not None
+            else f"/temp-queue/amq-reply-{uuid.uuid4().hex}"
+        )
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        # correlation id -> (future, reply IU type, request IU, timeout timer)
+        self.pending = dict()
+        reader.add_requester(self)
+
+    def request(
+        self,
+        iu,
+        destination,
+        reply_iu_type,
+        headers=None,
+        timeout=None,
+        callback=None,
+    ):
+        """Sends an IU as a request to a destination.
+
+        Args:
+            iu (IncrementalUnit): the request IU.
+            destination (str): the ActiveMQ destination of the service.
+            reply_iu_type (type): the IU type created from the reply.
+            headers (dict): additional headers of the request.
+            timeout (float): time in seconds to wait for a reply, the requester's timeout by default.
+            callback (Callable[[Future], None]): function called with the future when it is done.
+
+        Returns:
+            concurrent.futures.Future: the future reply IU. Use `asyncio.wrap_future` to await it in a coroutine.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        if not self.slots.acquire(timeout=timeout):
+            future.set_exception(
+                TimeoutError(f"no request slot available after {timeout} s")
+            )
+            return future
+        future.add_done_callback(lambda _: self.slots.release())
+
+        correlation_id = uuid.uuid4().hex
+        timer = threading.Timer(timeout, self.expire, args=(correlation_id,))
+        timer.daemon = True
+        with self.lock:
+            self.pending[correlation_id] = (future, reply_iu_type, iu, timer)
+
+        request_headers = dict(headers) if headers is not None else {}
+        request_headers.update(
+            {
+                "reply-to": self.reply_destination,
+                "correlation-id": correlation_id,
+                "priority": STOMP_PRIORITIES[PRIORITY_CONTROL],
+                "persistent": "false",
+                "expires": str(int((time.time() + timeout) * 1000)),
+            }
+        )
+        try:
+            self.reader.conn.send(
+                body=json.dumps(self.writer.iu_to_json(iu)),
+                destination=destination,
+                headers=request_headers,
+            )
+        except Exception as e:
+            self.fail(correlation_id, e)
+            return future
+        timer.start()
+        return future
+
+    def expects(self, correlation_id):
+        """Returns True if a request with this correlation id is waiting for its reply."""
+        return correlation_id in self.pending
+
+    def reply_iu_type(self, correlation_id):
+        """Returns the IU type of the reply to the request with this correlation id."""
+        pending = self.pending.get(correlation_id)
+        return pending[1] if pending is not None else None
+
+    def _pop(self, correlation_id):
+        with self.lock:
+            pending = self.pending.pop(correlation_id, None)
+        if pending is not None:
+            pending[3].cancel()
+        return pending
+
+    def resolve(self, correlation_id, reply_iu):
+        """Completes the request with this correlation id with its reply IU, grounded in the request IU.
+
+        Args:
+            correlation_id (str): the correlation id of the request.
+            reply_iu (IncrementalUnit): the IU created from the reply.
+        """
+        pending = self._pop(correlation_id)
+        if pending is None:
+            return
+        future, _, request_iu, _ = pending
+        if reply_iu.grounded_in is None:
+            reply_iu.grounded_in = request_iu
+        future.set_result(reply_iu)
+
+    def fail(self, correlation_id, exception):
+        """Fails the request with this correlation id.
+
+        Args:
+            correlation_id (str): the correlation id of the request.
+            exception (Exception): the reason of the failure.
+        """
+        pending = self._pop(correlation_id)
+        if pending is not None:
+            pending[0].set_exception(exception)
+
+    def expire(self, correlation_id):
+        """Fails the request with this correlation id if it is still waiting for its reply."""
+        self.fail(
+            correlation_id,
+            TimeoutError(f"no reply received for request {correlation_id}"),
+        )
+
+    def cancel_all(self):
+        """Fails all requests waiting for their reply, e.g. before shutting down the network."""
+        for correlation_id in list(self.pending):
+            self.fail(correlation_id, RuntimeError("request cancelled"))
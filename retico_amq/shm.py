@@ -0,0 +1,177 @@
+"""
+AMQ Shared Memory
+=================
+
+This module defines SharedMemoryRing, a shared memory segment used by AMQWriter to send large message bodies to
+co-located AMQReaders without pushing them through ActiveMQ : the body is written in the segment, and only a small
+handle (`amq-shm` header) is sent through ActiveMQ.
+
+Each body is written in a slot of the ring, preceded by a small header containing the slot's generation and length.
+A slot is kept at least `retention` seconds before being reused, after which a reader still holding its handle detects
+that the slot was overwritten (different generation) and drops the message.
+The writer unlinks the segment when it shuts down, the readers only close their mapping.
+"""
+
+import socket
+import struct
+import time
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+
+# generation (unsigned 64 bits) and length (unsigned 32 bits) of a slot
+SLOT_HEADER = struct.Struct("<QI")
+
+# names of the segments created by this process, that the process' resource tracker has to unlink
+_created_segments = set()
+
+
+class SharedMemoryRing:
+    """Ring of variable-size slots in a shared memory segment."""
+
+    def __init__(self, name=None, size=64 * 1024 * 1024, retention=5.0, create=True):
+        """Initializes the SharedMemoryRing, creating a new segment or attaching to an existing one.
+
+        Args:
+            name (str): the name of the segment, a random name by default.
+            size (int): the size of the segment in bytes (only used when creating the segment).
+            retention (float): minimum time in seconds a slot is kept before being reused.
+            create (bool): True to create the segment (writer side), False to attach to it (reader side).
+        """
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        if create:
+            _created_segments.add(self.shm._name)
+        elif self.shm._name not in _created_segments:
+            # the segment belongs to the writer's process, the reader's resource tracker must not unlink it
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.name = self.shm.name
+        self.size = self.shm.size
+        self.retention = retention
+        self.owner = create
+        self.host = socket.gethostname()
+        self.generation = 0
+        # (start, end, write time) of the slots in use, oldest first
+        self.slots = deque()
+
+    @classmethod
+    def attach(cls, name):
+        """Attaches to the segment created by a writer."""
+        return cls(name=name, create=False)
+
+    def _reclaim(self):
+        now = time.monotonic()
+        while self.slots and now - self.slots[0][2] > self.retention:
+            self.slots.popleft()
+
+    def _allocate(self, size):
+        self._reclaim()
+        if not self.slots:
+            return 0 if size <= self.size else None
+        first_start = self.slots[0][0]
+        last_start, last_end, _ = self.slots[-1]
+        if last_start >= first_start:
+            # the used slots are contiguous : write after them, or wrap to the beginning of the segment
+            if last_end + size <= self.size:
+                return last_end
+            if size <= first_start:
+                return 0
+            return None
+        # the used slots wrap around the end of the segment : write between the last and the first slot
+        if last_end + size <= first_start:
+            return last_end
+        return None
+
+    def write(self, data):
+        """Writes data in a new slot.
+
+        Args:
+            data (bytes): the data to write.
+
+        Returns:
+            str: the handle of the slot, to send in the `amq-shm` header, None if there is no free slot big enough.
+        """
+        size = SLOT_HEADER.size + len(data)
+        start = self._allocate(size)
+        if start is None:
+            return None
+        self.generation += 1
+        SLOT_HEADER.pack_into(self.shm.buf, start, self.generation, len(data))
+        self.shm.buf[start + SLOT_HEADER.size : start + size] = data
+        self.slots.append((start, start + size, time.monotonic()))
+        return f"{self.host}:{self.name}:{start}:{len(data)}:{self.generation}"
+
+    def read(self, offset, length, generation):
+        """Returns a zero-copy view of a slot's data, None if the slot was overwritten.
+
+        Args:
+            offset (int): the offset of the slot.
+            length (int): the length of the data.
+            generation (int): the generation of the slot.
+        """
+        if not self.is_valid(offset, length, generation):
+            return None
+        start = offset + SLOT_HEADER.size
+        return self.shm.buf[start : start + length]
+
+    def is_valid(self, offset, length, generation):
+        """Returns True if the slot has not been overwritten, to check after the data was read."""
+        if offset < 0 or offset + SLOT_HEADER.size + length > self.size:
+            return False
+        return SLOT_HEADER.unpack_from(self.shm.buf, offset) == (generation, length)
+
+    def close(self):
+        """Closes the mapping of the segment, and destroys the segment if it was created by this ring."""
+        self.slots.clear()
+        try:
+            self.shm.close()
+        except BufferError:
+            # a view on the segment is still alive, the mapping is released with it
+            pass
+        if self.owner:
+            self.shm.unlink()
+            _created_segments.discard(self.shm._name)
+
+
+def parse_shm_handle(handle):
+    """Splits an `amq-shm` header into (host, segment name, offset, length, generation)."""
+    host, name, offset, length, generation = handle.rsplit(":", 4)
+    return host, name, int(offset), int(length), int(generation)
+
+
+class SharedMemoryReader:
+    """Resolves the `amq-shm` handles received by an AMQReader, attaching to the writers' segments when needed."""
+
+    def __init__(self):
+        self.host = socket.gethostname()
+        # segment name -> SharedMemoryRing
+        self.rings = dict()
+
+    def read(self, handle):
+        """Returns the data of a slot, None if the segment is on another host, or the slot was overwritten.
+
+        Args:
+            handle (str): the `amq-shm` header of the message.
+        """
+        host, name, offset, length, generation = parse_shm_handle(handle)
+        if host != self.host:
+            return None
+        ring = self.rings.get(name)
+        if ring is None:
+            try:
+                ring = self.rings[name] = SharedMemoryRing.attach(name)
+            except FileNotFoundError:
+                return None
+        view = ring.read(offset, length, generation)
+        if view is None:
+            return None
+        # the data is copied once, for the decoder, then checked against a concurrent overwrite
+        data = bytes(view)
+        view.release()
+        if not ring.is_valid(offset, length, generation):
+            return None
+        return data
+
+    def close(self):
+        """Closes the mappings of all attached segments."""
+        for ring in self.rings.values():
+            ring.close()
+        self.rings.clear()
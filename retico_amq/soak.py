@@ -0,0 +1,843 @@
+"""
+AMQ Soak Test
+=============
+
+This module defines a soak test harness, running the AMQBridge -> AMQWriter -> AMQReader pipeline for a long time
+against StubBroker, a minimal local STOMP broker standing in for ActiveMQ, and detecting the problems that only show up
+late in long sessions : memory growth (RSS and Python allocations), thread leaks, queues growing without bound, latency
+drift and message loss.
+
+The harness samples the process at a fixed interval, compares the end of the run with the state after the warm-up, and
+fails when a growth exceeds its threshold. The top allocators (tracemalloc) are reported to locate a leak.
+
+Run it from the command line (exit code 1 on failure) :
+    python -m retico_amq.soak --duration 3600 --rate 50 --revoke 0.1 --commit 0.1
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+
+import retico_core
+from retico_core.log_utils import log_exception
+
+from retico_amq.amq import (
+    AMQBridge,
+    AMQReader,
+    AMQWriter,
+    DestinationRouter,
+    join_thread,
+)
+
+# maximum growth over the run (after the warm-up) before the soak test fails
+SOAK_THRESHOLDS = {
+    # resident memory, in bytes
+    "rss_growth": 64 * 1024 * 1024,
+    # memory allocated by Python (tracemalloc), in bytes
+    "traced_growth": 32 * 1024 * 1024,
+    # threads still alive after the network is stopped
+    "thread_leak": 0,
+    # increase of the mean latency between the first and the last sample, in seconds
+    "latency_drift": 0.1,
+    # messages waiting in the reader's or the writer's queue
+    "queue_depth": 1000,
+    # ratio of the sent messages that were not received
+    "loss": 0.01,
+    # added IUs received before an IU of their group added earlier
+    "reordered": 0,
+}
+
+
+def rss_bytes():
+    """Returns the resident memory of the process in bytes, None if it can't be read on this platform."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak resident memory, in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+def escape_header(value):
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\r", "\\r")
+        .replace("\n", "\\n")
+        .replace(":", "\\c")
+    )
+
+
+def unescape_header(value):
+    if "\\" not in value:
+        return value
+    escapes = {"\\": "\\", "r": "\r", "n": "\n", "c": ":"}
+    chars = iter(value)
+    return "".join(escapes.get(next(chars, ""), "") if c == "\\" else c for c in chars)
+
+
+class StubClient:
+    """Connection of a client to the StubBroker."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.connected = True
+
+    def send(self, command, headers, body=b""):
+        """Sends a frame to the client.
+
+        Args:
+            command (str): the STOMP command.
+            headers (dict): the headers of the frame.
+            body (bytes): the body of the frame.
+        """
+        lines = [command]
+        lines.extend(
+            f"{escape_header(k)}:{escape_header(v)}" for k, v in headers.items()
+        )
+        lines.append(f"content-length:{len(body)}")
+        data = ("\n".join(lines) + "\n\n").encode() + body + b"\x00"
+        with self.lock:
+            if not self.connected:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.connected = False
+
+    def close(self):
+        with self.lock:
+            self.connected = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class StubBroker:
+    """Minimal STOMP broker over TCP, standing in for ActiveMQ in soak tests.
+    It supports CONNECT, SUBSCRIBE, UNSUBSCRIBE, SEND, DISCONNECT and receipts, ActiveMQ's wildcards, expired messages,
+    and delivers the messages of a topic to all its subscribers, and the messages of a queue (`/queue/` or
+    `/temp-queue/`) to one of its subscribers in turn, all the messages of a message group (`JMSXGroupID` header) being
+    delivered to the same subscriber. The messages of a virtual topic (`/topic/VirtualTopic.<name>`) are also
+    delivered to its consumer queues (`/queue/Consumer.<group>.VirtualTopic.<name>`).
+    Messages are not persisted, and are dropped if a queue has no subscriber.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """Initializes the StubBroker.
+
+        Args:
+            host (str): the interface to listen on.
+            port (int): the port to listen on, 0 to pick a free port.
+        """
+        self.host = host
+        self.port = port
+        self.server = None
+        self.accept_thread = None
+        # threads serving the clients
+        self.threads = []
+        self.clients = []
+        # (client, subscription id, pattern, router)
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.round_robin = dict()
+        # (queue, message group) -> subscription, of the most recent groups
+        self.groups = OrderedDict()
+        self.max_groups = 1024
+        self.message_ids = itertools.count()
+        self.nb_received = 0
+        self.nb_delivered = 0
+        self.nb_dropped = 0
+
+    def start(self):
+        """Starts listening, returns the broker (its `port` is the actual port)."""
+        self.server = socket.create_server((self.host, self.port))
+        # accept() is not interrupted by close() on every platform
+        self.server.settimeout(0.2)
+        self.port = self.server.getsockname()[1]
+        self.accept_thread = threading.Thread(target=self.accept, daemon=True)
+        self.accept_thread.start()
+        return self
+
+    def stop(self):
+        """Closes the connections and stops the broker's threads."""
+        if self.server is None:
+            return
+        server, self.server = self.server, None
+        self.accept_thread.join(1.0)
+        server.close()
+        with self.lock:
+            clients = list(self.clients)
+            threads, self.threads = self.threads, []
+        for client in clients:
+            client.close()
+        for thread in threads:
+            thread.join(1.0)
+
+    def accept(self):
+        server = self.server
+        while self.server is not None:
+            try:
+                sock, _ = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = StubClient(sock)
+            thread = threading.Thread(target=self.serve, args=(client,), daemon=True)
+            with self.lock:
+                self.clients.append(client)
+                self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+            thread.start()
+
+    def serve(self, client):
+        buffer = b""
+        try:
+            while client.connected:
+                data = client.sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                while True:
+                    frame, buffer = self.parse_frame(buffer)
+                    if frame is None:
+                        break
+                    self.handle(client, *frame)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+                self.subscriptions = [
+                    s for s in self.subscriptions if s[0] is not client
+                ]
+            client.close()
+
+    @staticmethod
+    def parse_frame(buffer):
+        """Parses the first frame of a buffer.
+
+        Returns:
+            tuple: ((command, headers, body) or None if the frame is incomplete, rest of the buffer)
+        """
+        # heart-beats
+        buffer = buffer.lstrip(b"\r\n")
+        end = buffer.find(b"\n\n")
+        if end < 0:
+            return None, buffer
+        lines = buffer[:end].decode().replace("\r", "").split("\n")
+        command = lines[0]
+        headers = dict()
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            if command not in ("CONNECT", "STOMP"):
+                key, value = unescape_header(key), unescape_header(value)
+            # the first occurrence of a repeated header is used
+            headers.setdefault(key, value)
+        start = end + 2
+        if "content-length" in headers:
+            body_end = start + int(headers["content-length"])
+            if len(buffer) <= body_end:
+                return None, buffer
+        else:
+            body_end = buffer.find(b"\x00", start)
+            if body_end < 0:
+                return None, buffer
+        return (command, headers, buffer[start:body_end]), buffer[body_end + 1 :]
+
+    def handle(self, client, command, headers, body):
+        if command in ("CONNECT", "STOMP"):
+            versions = headers.get("accept-version", "1.0").split(",")
+            version = max(v for v in versions if v in ("1.0", "1.1", "1.2"))
+            client.send(
+                "CONNECTED",
+                {"version": version, "heart-beat": "0,0", "server": "retico-amq-stub"},
+            )
+        elif command == "SUBSCRIBE":
+            router = DestinationRouter()
+            router.add(headers["destination"], True)
+            with self.lock:
+                self.subscriptions.append(
+                    (
+                        client,
+                        headers.get("id", headers["destination"]),
+                        headers["destination"],
+                        router,
+                    )
+                )
+        elif command == "UNSUBSCRIBE":
+            with self.lock:
+                self.subscriptions = [
+                    s
+                    for s in self.subscriptions
+                    if s[0] is not client or s[1] != headers.get("id")
+                ]
+        elif command == "SEND":
+            self.deliver(headers, body)
+        if "receipt" in headers:
+            client.send("RECEIPT", {"receipt-id": headers["receipt"]})
+        if command == "DISCONNECT":
+            client.connected = False
+
+    def queue_consumer(self, queue, headers):
+        """Returns the subscription receiving a message sent to a queue : the consumer of the message's group
+        (`JMSXGroupID` header) if it is still subscribed, otherwise the next consumer in turn.
+        """
+        subscriptions = [s for s in self.subscriptions if s[3].resolve(queue)]
+        if not subscriptions:
+            return None
+        group = headers.get("JMSXGroupID")
+        subscription = self.groups.get((queue, group))
+        if subscription not in subscriptions:
+            turn = self.round_robin.get(queue, 0)
+            self.round_robin[queue] = turn + 1
+            subscription = subscriptions[turn % len(subscriptions)]
+            if group is not None:
+                self.groups[(queue, group)] = subscription
+                if len(self.groups) > self.max_groups:
+                    self.groups.popitem(last=False)
+        return subscription
+
+    def deliver(self, headers, body):
+        """Delivers a sent message to the subscribers of its destination.
+
+        Args:
+            headers (dict): the headers of the SEND frame.
+            body (bytes): the body of the message.
+        """
+        destination = headers["destination"]
+        self.nb_received += 1
+        expires = int(headers.get("expires", 0) or 0)
+        if expires and expires < time.time() * 1000:
+            self.nb_dropped += 1
+            return
+        with self.lock:
+            if destination.startswith("/topic/"):
+                subscriptions = [
+                    s for s in self.subscriptions if s[3].resolve(destination)
+                ]
+                # each consumer queue of a virtual topic receives a copy of the message
+                name = destination[len("/topic/") :]
+                if name.startswith("VirtualTopic."):
+                    queues = {
+                        s[2]
+                        for s in self.subscriptions
+                        if s[2].startswith("/queue/Consumer.")
+                        and s[2].endswith("." + name)
+                    }
+                    for queue in queues:
+                        subscriptions.append(self.queue_consumer(queue, headers))
+            else:
+                subscription = self.queue_consumer(destination, headers)
+                subscriptions = [subscription] if subscription is not None else []
+        if not subscriptions:
+            self.nb_dropped += 1
+            return
+        message_headers = {
+            k: v
+            for k, v in headers.items()
+            if k not in ("content-length", "receipt", "transaction")
+        }
+        message_headers["message-id"] = f"stub-{next(self.message_ids)}"
+        for client, subscription_id, _, _ in subscriptions:
+            client.send(
+                "MESSAGE",
+                {**message_headers, "subscription": str(subscription_id)},
+                body,
+            )
+            self.nb_delivered += 1
+
+
+class SoakIU(retico_core.IncrementalUnit):
+    """IU exchanged during a soak test, carrying its sending time, a payload of configurable size, and its message
+    group (e.g. a turn)."""
+
+    @staticmethod
+    def type():
+        return "Soak IU"
+
+    def __init__(
+        self,
+        creator=None,
+        iuid=0,
+        previous_iu=None,
+        grounded_in=None,
+        sent_at=None,
+        data=None,
+        group=None,
+        **kwargs,
+    ):
+        super().__init__(
+            creator=creator,
+            iuid=iuid,
+            previous_iu=previous_iu,
+            grounded_in=grounded_in,
+            payload=data,
+        )
+        self.sent_at = sent_at
+        self.data = data
+        self.group = group
+
+
+class SoakProducerModule(retico_core.abstract.AbstractProducingModule):
+    """A Module producing SoakIUs at a fixed rate, with a mix of ADD, REVOKE and COMMIT updates."""
+
+    @staticmethod
+    def name():
+        return "SoakProducer Module"
+
+    @staticmethod
+    def description():
+        return "A Module producing SoakIUs at a fixed rate"
+
+    @staticmethod
+    def output_iu():
+        return SoakIU
+
+    def __init__(
+        self,
+        rate=50.0,
+        revoke=0.0,
+        commit=0.0,
+        payload_size=256,
+        group_size=10,
+        seed=0,
+        **kwargs,
+    ):
+        """Initializes the SoakProducerModule.
+
+        Args:
+            rate (float): number of update messages produced per second.
+            revoke (float): ratio of the update messages revoking a recently added IU.
+            commit (float): ratio of the update messages committing a recently added IU.
+            payload_size (int): size of the IUs' payload, in characters.
+            group_size (int): number of update messages of a message group.
+            seed (int): seed of the update types draw.
+        """
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.revoke = revoke
+        self.commit = commit
+        self.payload = "x" * payload_size
+        self.group_size = group_size
+        self.random = random.Random(seed)
+        self.recent_ius = deque(maxlen=16)
+        self.nb_sent = 0
+        self.nb_errors = 0
+        self._tts_thread_active = False
+        self._thread = None
+
+    def prepare_run(self):
+        super().prepare_run()
+        self._tts_thread_active = True
+        self._thread = threading.Thread(target=self.run_process)
+        self._thread.start()
+
+    def shutdown(self):
+        super().shutdown()
+        self._tts_thread_active = False
+        join_thread(self._thread)
+        self._thread = None
+
+    def process_update(self, update_message):
+        pass
+
+    def next_update(self):
+        """Returns the next IU and its update type."""
+        draw = self.random.random()
+        if self.recent_ius and draw < self.revoke:
+            return self.recent_ius.pop(), retico_core.UpdateType.REVOKE
+        if self.recent_ius and draw < self.revoke + self.commit:
+            return self.recent_ius.popleft(), retico_core.UpdateType.COMMIT
+        iu = self.create_iu(
+            sent_at=time.time(),
+            data=self.payload,
+            group=self.nb_sent // self.group_size,
+        )
+        self.recent_ius.append(iu)
+        return iu, retico_core.UpdateType.ADD
+
+    def run_process(self):
+        next_time = time.monotonic()
+        while self._tts_thread_active:
+            try:
+                iu, ut = self.next_update()
+                um = retico_core.UpdateMessage()
+                um.add_iu(iu, ut)
+                self.append(um)
+                self.nb_sent += 1
+            except Exception as e:
+                log_exception(module=self, exception=e)
+                self.nb_errors += 1
+            # a failing update keeps its slot, so that errors don't turn into a busy loop
+            next_time += 1 / self.rate
+            time.sleep(max(0.0, next_time - time.monotonic()))
+
+
+class SoakSinkModule(retico_core.abstract.AbstractConsumingModule):
+    """A Module receiving the SoakIUs from an AMQReader, recording their latency and counting the IUs received out of
+    order within their group."""
+
+    @staticmethod
+    def name():
+        return "SoakSink Module"
+
+    @staticmethod
+    def description():
+        return "A Module recording the latency of the received SoakIUs"
+
+    @staticmethod
+    def input_ius():
+        return [SoakIU]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.nb_received = 0
+        self.nb_reordered = 0
+        self.latencies = []
+        # group -> sending time of the last added IU, of the most recent groups
+        self.last_sent = OrderedDict()
+        self.lock = threading.Lock()
+
+    def process_update(self, update_message):
+        now = time.time()
+        for iu, ut in update_message:
+            self.nb_received += 1
+            if ut != retico_core.UpdateType.ADD or iu.sent_at is None:
+                continue
+            with self.lock:
+                self.latencies.append(now - iu.sent_at)
+            last_sent = self.last_sent.get(iu.group)
+            if last_sent is not None and iu.sent_at < last_sent:
+                self.nb_reordered += 1
+            self.last_sent[iu.group] = max(iu.sent_at, last_sent or 0)
+            self.last_sent.move_to_end(iu.group)
+            if len(self.last_sent) > 1024:
+                self.last_sent.popitem(last=False)
+
+    def pop_latencies(self):
+        """Returns and clears the latencies recorded since the last call."""
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+
+def percentile(values, q):
+    """Returns the q-th percentile (0-100) of a list of values, None if it is empty."""
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[
+        min(98, max(0, q - 1))
+    ]
+
+
+class SoakReport:
+    """Samples, top allocators and failures of a soak test."""
+
+    def __init__(self, config, thresholds):
+        self.config = config
+        self.thresholds = thresholds
+        self.samples = []
+        self.top_allocators = []
+        self.growth = dict()
+        self.failures = []
+
+    @property
+    def passed(self):
+        return not self.failures
+
+    def check(self, name, value):
+        """Records the growth of a quantity, and a failure if it exceeds its threshold."""
+        self.growth[name] = value
+        threshold = self.thresholds.get(name)
+        if value is not None and threshold is not None and value > threshold:
+            self.failures.append(f"{name} {value:.6g} above threshold {threshold:.6g}")
+
+    def fail(self, reason):
+        """Records a failure that is not a growth, e.g. a pipeline that didn't carry any message."""
+        self.failures.append(reason)
+
+    def to_dict(self):
+        return {
+            "passed": self.passed,
+            "failures": self.failures,
+            "growth": self.growth,
+            "thresholds": self.thresholds,
+            "config": self.config,
+            "top_allocators": self.top_allocators,
+            "samples": self.samples,
+        }
+
+
+class SoakHarness:
+    """Runs the AMQBridge -> AMQWriter -> StubBroker -> AMQReader pipeline for a given duration and message mix, and
+    checks that memory, threads, queues and latency stay bounded.
+    """
+
+    def __init__(
+        self,
+        duration=60.0,
+        rate=50.0,
+        revoke=0.0,
+        commit=0.0,
+        payload_size=256,
+        destination="/topic/soak",
+        consumers=1,
+        warmup=5.0,
+        sample_interval=5.0,
+        thresholds=None,
+        top_allocators=10,
+        writer_kwargs=None,
+        reader_kwargs=None,
+        bridge_kwargs=None,
+    ):
+        """Initializes the SoakHarness.
+
+        Args:
+            duration (float): duration of the run after the warm-up, in seconds.
+            rate (float): number of update messages produced per second.
+            revoke (float): ratio of the update messages revoking a recently added IU.
+            commit (float): ratio of the update messages committing a recently added IU.
+            payload_size (int): size of the IUs' payload, in characters.
+            destination (str): the destination the IUs are exchanged on.
+            consumers (int): number of competing consumers of the AMQReader, the destination has to be a queue or a
+                virtual topic if there are several. The messages are grouped by `SoakIU.group`.
+            warmup (float): time in seconds before the reference sample is taken.
+            sample_interval (float): time in seconds between two samples.
+            thresholds (dict): thresholds overriding `SOAK_THRESHOLDS`, a None threshold disables its check.
+            top_allocators (int): number of allocation sites with the largest growth reported.
+            writer_kwargs (dict): additional arguments of the AMQWriter.
+            reader_kwargs (dict): additional arguments of the AMQReader.
+            bridge_kwargs (dict): additional arguments of the AMQBridge.
+        """
+        self.duration = duration
+        self.rate = rate
+        self.revoke = revoke
+        self.commit = commit
+        self.payload_size = payload_size
+        self.destination = destination
+        self.consumers = consumers
+        self.warmup = warmup
+        self.sample_interval = sample_interval
+        self.thresholds = {**SOAK_THRESHOLDS, **(thresholds or {})}
+        self.nb_top_allocators = top_allocators
+        self.writer_kwargs = writer_kwargs or {}
+        self.reader_kwargs = reader_kwargs or {}
+        self.bridge_kwargs = bridge_kwargs or {}
+
+    def config(self):
+        return {
+            "duration": self.duration,
+            "rate": self.rate,
+            "revoke": self.revoke,
+            "commit": self.commit,
+            "payload_size": self.payload_size,
+            "destination": self.destination,
+            "consumers": self.consumers,
+            "warmup": self.warmup,
+            "sample_interval": self.sample_interval,
+        }
+
+    def sample(self, start, reader, writer, sink):
+        """Returns the current state of the process and of the pipeline."""
+        latencies = sink.pop_latencies()
+        return {
+            "elapsed": time.monotonic() - start,
+            "rss": rss_bytes(),
+            "traced": tracemalloc.get_traced_memory()[0],
+            "threads": threading.active_count(),
+            "reader_queue": len(reader.queue)
+            + sum(len(consumer.queue) for consumer in reader.consumers),
+            "writer_queue": len(writer.queue),
+            "received": sink.nb_received,
+            "latency_mean": statistics.fmean(latencies) if latencies else None,
+            "latency_p95": percentile(latencies, 95),
+        }
+
+    def run(self):
+        """Runs the soak test.
+
+        Returns:
+            SoakReport: the samples and the failures of the run.
+        """
+        report = SoakReport(self.config(), self.thresholds)
+        threads_before = set(threading.enumerate())
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(10)
+        broker = StubBroker().start()
+        producer = SoakProducerModule(
+            rate=self.rate,
+            revoke=self.revoke,
+            commit=self.commit,
+            payload_size=self.payload_size,
+        )
+        bridge = AMQBridge(None, self.destination, **self.bridge_kwargs)
+        writer = AMQWriter(ip=broker.host, port=broker.port, **self.writer_kwargs)
+        reader = AMQReader(ip=broker.host, port=broker.port, **self.reader_kwargs)
+        reader.add(
+            destination=self.destination,
+            target_iu_type=SoakIU,
+            consumers=self.consumers,
+        )
+        writer.set_group_by(self.destination, "group")
+        sink = SoakSinkModule()
+        reference = last = None
+        leaked = []
+        producer.subscribe(bridge)
+        bridge.subscribe(writer)
+        reader.subscribe(sink)
+        try:
+            start = time.monotonic()
+            # the reader subscribes before the producer starts, so that no message is dropped by the broker
+            retico_core.network.run([reader, producer])
+            time.sleep(self.warmup)
+            sink.pop_latencies()
+            time.sleep(min(self.sample_interval, self.duration))
+            reference = self.sample(start, reader, writer, sink)
+            reference_snapshot = tracemalloc.take_snapshot()
+            report.samples.append(reference)
+            end = start + self.warmup + self.duration
+            while time.monotonic() < end:
+                time.sleep(max(0.0, min(self.sample_interval, end - time.monotonic())))
+                sample = self.sample(start, reader, writer, sink)
+                report.samples.append(sample)
+                depth = max(sample["reader_queue"], sample["writer_queue"])
+                if (
+                    self.thresholds["queue_depth"] is not None
+                    and depth > self.thresholds["queue_depth"]
+                ):
+                    break
+            last = report.samples[-1]
+            report.top_allocators = [
+                {
+                    "site": str(stat.traceback),
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in tracemalloc.take_snapshot().compare_to(
+                    reference_snapshot, "lineno"
+                )[: self.nb_top_allocators]
+            ]
+            producer._tts_thread_active = False
+            # lets the in-flight messages be received
+            drain_end = time.monotonic() + 2.0
+            while sink.nb_received < producer.nb_sent and time.monotonic() < drain_end:
+                time.sleep(0.05)
+        finally:
+            retico_core.network.stop([reader, producer])
+            # the modules shut down from their own threads, they have to disconnect before the broker stops
+            shutdown_end = time.monotonic() + 5.0
+            while time.monotonic() < shutdown_end and (
+                reader._thread is not None or writer._thread is not None
+            ):
+                time.sleep(0.05)
+            # leaves the modules' threads time to stop, the broker is still running as ActiveMQ would, so that
+            # connections that are never closed are detected
+            leak_end = time.monotonic() + 5.0
+            while time.monotonic() < leak_end:
+                broker_threads = set(broker.threads) | {broker.accept_thread}
+                leaked = [
+                    t
+                    for t in threading.enumerate()
+                    if t not in threads_before and t not in broker_threads
+                ]
+                if not leaked:
+                    break
+                time.sleep(0.1)
+            broker.stop()
+            if not tracing:
+                tracemalloc.stop()
+
+        # a pipeline that doesn't carry any message can't leak nor drift, it fails instead of passing
+        if producer.nb_sent == 0:
+            report.fail(f"no message sent ({producer.nb_errors} producer errors)")
+        elif sink.nb_received == 0:
+            report.fail("no message received")
+        if reference["rss"] is not None and last["rss"] is not None:
+            report.check("rss_growth", last["rss"] - reference["rss"])
+        report.check("traced_growth", last["traced"] - reference["traced"])
+        report.check("thread_leak", len(leaked))
+        report.growth["leaked_threads"] = [t.name for t in leaked]
+        if reference["latency_mean"] is None or last["latency_mean"] is None:
+            report.fail("no latency sample after the warm-up or at the end of the run")
+        else:
+            report.check(
+                "latency_drift", last["latency_mean"] - reference["latency_mean"]
+            )
+        report.check(
+            "queue_depth",
+            max(max(s["reader_queue"], s["writer_queue"]) for s in report.samples),
+        )
+        if producer.nb_sent:
+            report.check("loss", 1 - sink.nb_received / producer.nb_sent)
+        report.check("reordered", sink.nb_reordered)
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Soak test of the retico-amq pipeline against a local stub broker"
+    )
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--rate", type=float, default=50.0)
+    parser.add_argument("--revoke", type=float, default=0.0)
+    parser.add_argument("--commit", type=float, default=0.0)
+    parser.add_argument("--payload-size", type=int, default=256)
+    parser.add_argument("--destination", default="/topic/soak")
+    parser.add_argument("--consumers", type=int, default=1)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--sample-interval", type=float, default=5.0)
+    parser.add_argument("--report", help="file to write the JSON report to")
+    for name, value in SOAK_THRESHOLDS.items():
+        parser.add_argument(
+            f"--max-{name.replace('_', '-')}", type=float, default=value, dest=name
+        )
+    args = parser.parse_args()
+    harness = SoakHarness(
+        duration=args.duration,
+        rate=args.rate,
+        revoke=args.revoke,
+        commit=args.commit,
+        payload_size=args.payload_size,
+        destination=args.destination,
+        consumers=args.consumers,
+        warmup=args.warmup,
+        sample_interval=args.sample_interval,
+        thresholds={name: getattr(args, name) for name in SOAK_THRESHOLDS},
+    )
+    report = harness.run()
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report.to_dict(), f, indent=2)
+    print(
+        json.dumps(
+            {k: v for k, v in report.to_dict().items() if k != "samples"}, indent=2
+        )
+    )
+    return 0 if report.passed else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
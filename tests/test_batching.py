@@ -0,0 +1,108 @@
+import json
+import time
+
+from stomp.utils import Frame
+
+from retico_amq.amq import AMQReader, AMQWriter
+from retico_amq.batching import AdaptiveBatchController
+
+
+def test_disabled_without_budget():
+    controller = AdaptiveBatchController()
+    assert controller.state("/topic/a") is None
+    controller.observe("/topic/a", 1, 0.001, 0.001, 10)
+    assert controller.report() == {"destinations": {}, "decisions": []}
+
+
+def test_budget_per_destination():
+    controller = AdaptiveBatchController(latency_budget=0.1)
+    controller.set_budget("/topic/b", 0.01)
+    controller.set_budget("/topic/c", None)
+    assert controller.state("/topic/a").budget == 0.1
+    assert controller.state("/topic/b").budget == 0.01
+    assert controller.state("/topic/c") is None
+
+
+def test_grows_with_backlog():
+    controller = AdaptiveBatchController(latency_budget=0.1, max_batch=3)
+    for _ in range(5):
+        controller.observe("/topic/a", 1, 0.001, 0.001, 10)
+    state = controller.state("/topic/a")
+    assert state.batch_size == 3
+    assert 0 < state.linger <= controller.max_linger
+    assert state.nb_batches == 5
+
+
+def test_shrinks_above_budget():
+    controller = AdaptiveBatchController(latency_budget=0.1)
+    for _ in range(4):
+        controller.observe("/topic/a", 1, 0.001, 0.001, 10)
+    linger = controller.state("/topic/a").linger
+    controller.observe("/topic/a", 5, 0.2, 0.001, 10)
+    state = controller.state("/topic/a")
+    assert state.batch_size == 2
+    assert state.linger == linger / 2
+    assert "above budget" in controller.report()["decisions"][-1]["reason"]
+
+
+def test_quiet_link():
+    controller = AdaptiveBatchController(latency_budget=0.1)
+    for _ in range(4):
+        controller.observe("/topic/a", 1, 0.001, 0.001, 10)
+    nb_decisions = len(controller.decisions)
+    controller.observe("/topic/a", 1, 0.001, 0.001, 0)
+    state = controller.state("/topic/a")
+    assert state.batch_size == 5
+    assert len(controller.decisions) == nb_decisions + 1
+    assert controller.decisions[-1]["reason"] == "quiet link, incomplete batch"
+    # a steady state changes nothing, and records no decision
+    controller.observe("/topic/a", 5, 0.07, 0.001, 0)
+    assert len(controller.decisions) == nb_decisions + 1
+    assert controller.report()["destinations"]["/topic/a"]["batches"] == 6
+
+
+def test_batch_round_trip():
+    now = int(time.time() * 1000)
+    batch = [
+        (
+            json.dumps({"requestID": "s:1", "text": "é\nb"}),
+            "/topic/a",
+            {"update_type": "add", "amq-iuid": "s:1", "persistent": "false"},
+            0.0,
+        ),
+        (
+            "{}",
+            "/topic/a",
+            {"update_type": "revoke", "amq-iuid": "s:1", "persistent": "true"},
+            0.0,
+        ),
+        (
+            "{}",
+            "/topic/a",
+            {"update_type": "add", "amq-iuid": "s:2", "expires": str(now - 1000)},
+            0.0,
+        ),
+    ]
+    body, headers = AMQWriter.merge_batch(batch)
+    assert headers["amq-batch"] == "3"
+    assert headers["amq-iuid"] == "s:1,s:1,s:2"
+    assert headers["persistent"] == "true"
+    # the batch doesn't expire before its last message
+    assert "expires" not in headers
+    assert "update_type" not in headers
+
+    reader = AMQReader(ip="localhost", port=61613)
+    frame = Frame("MESSAGE", {**headers, "destination": "/topic/a"}, body)
+    frames = reader.unbatch(frame)
+    # the expired message is dropped, the others keep their own headers and body
+    assert [f.body for f in frames] == [batch[0][0], "{}"]
+    assert [f.headers["update_type"] for f in frames] == ["add", "revoke"]
+    assert all(f.headers["destination"] == "/topic/a" for f in frames)
+    assert all("amq-batch" not in f.headers for f in frames)
+    assert json.loads(frames[0].body)["text"] == "é\nb"
+
+
+def test_unbatch_single_message():
+    reader = AMQReader(ip="localhost", port=61613)
+    frame = Frame("MESSAGE", {"destination": "/topic/a"}, "{}")
+    assert reader.unbatch(frame) == [frame]
@@ -0,0 +1,74 @@
+import retico_core
+from stomp.utils import Frame
+
+from retico_amq.amq import AMQIU, AMQReader, AMQWriter
+
+
+class TextIU(retico_core.IncrementalUnit):
+    def __init__(self, text=None, **kwargs):
+        super().__init__(**kwargs)
+        self.text = text
+
+
+def amq_iu(iu, destination):
+    return AMQIU(
+        creator=iu.creator, decorated_iu=iu, headers={}, destination=destination
+    )
+
+
+def sent_frames(writer):
+    frames = []
+    while len(writer.queue):
+        body, destination, headers, _ = writer.queue.get(0)
+        frames.append(Frame("MESSAGE", {**headers, "destination": destination}, body))
+    return frames
+
+
+def test_iu_to_json():
+    writer = AMQWriter(ip="localhost", port=61613)
+    source = retico_core.AbstractModule()
+    first = TextIU(creator=source, iuid="s:1", text="a")
+    second = TextIU(
+        creator=source, iuid="s:2", text="b", previous_iu=first, grounded_in=first
+    )
+    msg_json = writer.iu_to_json(second)
+    assert msg_json["requestID"] == "s:2"
+    assert msg_json["text"] == "b"
+    # the links to other IUs are sent as iuids
+    assert msg_json["previousRequestID"] == "s:1"
+    assert msg_json["groundedInRequestID"] == "s:1"
+    assert "creator" not in msg_json and "iuid" not in msg_json
+
+
+def test_envelope_round_trip():
+    writer = AMQWriter(ip="localhost", port=61613, envelope=True)
+    source = retico_core.AbstractModule()
+    first = TextIU(creator=source, iuid="s:1", text="a")
+    second = TextIU(creator=source, iuid="s:2", text="b", grounded_in=first)
+    other = TextIU(creator=source, iuid="s:3", text="c")
+    um = retico_core.UpdateMessage()
+    um.add_iu(amq_iu(first, "/topic/test"), retico_core.UpdateType.ADD)
+    um.add_iu(amq_iu(second, "/topic/test"), retico_core.UpdateType.COMMIT)
+    um.add_iu(amq_iu(other, "/topic/other"), retico_core.UpdateType.ADD)
+    writer.process_update(um)
+    frames = sent_frames(writer)
+    # one envelope per destination
+    assert sorted(frame.headers["amq-iuid"] for frame in frames) == ["s:1,s:2", "s:3"]
+
+    reader = AMQReader(ip="localhost", port=61613)
+    reader.add("/topic/test", TextIU)
+    reader.add("/topic/other", TextIU)
+    received = []
+    reader.append = received.append
+    for frame in frames:
+        reader.process_frame(frame)
+    # each envelope is received as a single UpdateMessage
+    messages = {
+        tuple(iu.text for iu, _ in update_message): list(update_message)
+        for update_message in received
+    }
+    assert set(messages) == {("a", "b"), ("c",)}
+    (received_first, add), (received_second, commit) = messages[("a", "b")]
+    assert add == retico_core.UpdateType.ADD
+    assert commit == retico_core.UpdateType.COMMIT
+    assert received_second.grounded_in is received_first
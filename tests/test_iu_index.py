@@ -0,0 +1,69 @@
+import retico_core
+from stomp.utils import Frame
+
+from retico_amq.amq import AMQReader, IUIndex
+
+
+def test_lru_eviction():
+    index = IUIndex(size=2)
+    index.add("/topic/a", "1", "iu 1")
+    index.add("/topic/a", "2", "iu 2")
+    # a lookup makes the IU the most recently used one
+    assert index.get("1", "/topic/a") == "iu 1"
+    index.add("/topic/a", "3", "iu 3")
+    assert index.get("2", "/topic/a") is None
+    assert index.get("1", "/topic/a") == "iu 1"
+    assert len(index) == 2
+
+
+def test_index_per_destination():
+    index = IUIndex(size=1)
+    index.add("/topic/a", 1, "iu a")
+    index.add("/topic/b", 1, "iu b")
+    # each destination keeps its own IUs, and the iuids are compared as strings
+    assert index.get("1", "/topic/a") == "iu a"
+    assert index.get("1", "/topic/b") == "iu b"
+    assert index.get("1", "/topic/c") in ("iu a", "iu b")
+    assert index.get(None, "/topic/a") is None
+
+
+def test_disabled_index():
+    index = IUIndex(size=0)
+    index.add("/topic/a", "1", "iu")
+    assert index.get("1", "/topic/a") is None
+    assert len(index) == 0
+
+
+class TextIU(retico_core.IncrementalUnit):
+    def __init__(self, text=None, **kwargs):
+        super().__init__(**kwargs)
+        self.text = text
+
+
+def test_iu_graph():
+    reader = AMQReader(ip="localhost", port=61613, iu_index_size=2)
+    reader.add("/topic/test", TextIU)
+    frame = Frame("MESSAGE", {"destination": "/topic/test", "amq-producer": "p"}, "")
+    first = reader.create_iu_from_json(frame, {"requestID": "s:1", "text": "a"})
+    second = reader.create_iu_from_json(
+        frame,
+        {
+            "requestID": "s:2",
+            "text": "b",
+            "previousRequestID": "s:1",
+            "groundedInRequestID": "s:1",
+        },
+    )
+    assert second.previous_iu is first
+    assert second.grounded_in is first
+    assert second.text == "b"
+    # without a known previous IU, the previous IU is the last one of the producer's stream
+    third = reader.create_iu_from_json(
+        frame, {"requestID": "s:3", "previousRequestID": "unknown"}
+    )
+    assert third.previous_iu is second
+    # "s:1" was evicted from the index
+    fourth = reader.create_iu_from_json(
+        frame, {"requestID": "s:4", "groundedInRequestID": "s:1"}
+    )
+    assert fourth.grounded_in is None
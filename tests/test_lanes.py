@@ -0,0 +1,108 @@
+import time
+
+import retico_core
+from stomp.utils import Frame
+
+from retico_amq.amq import (
+    AMQIU,
+    PRIORITY_BULK,
+    PRIORITY_CONTROL,
+    PRIORITY_DEFAULT,
+    AMQReader,
+    AMQWriter,
+    PriorityLanes,
+)
+
+
+def test_most_urgent_lane_first():
+    lanes = PriorityLanes()
+    lanes.append("bulk", PRIORITY_BULK)
+    lanes.append("default", PRIORITY_DEFAULT)
+    lanes.append("control", PRIORITY_CONTROL)
+    assert [lanes.get(0) for _ in range(3)] == ["control", "default", "bulk"]
+    assert lanes.get(0) is None
+
+
+def test_starvation():
+    lanes = PriorityLanes(starvation_timeout=0.01)
+    lanes.append("bulk", PRIORITY_BULK)
+    time.sleep(0.02)
+    lanes.append("control", PRIORITY_CONTROL)
+    assert lanes.get(0) == "bulk"
+    assert lanes.lane_stats()[PRIORITY_BULK]["starved"] == 1
+
+
+def test_last_lane():
+    lanes = PriorityLanes()
+    lanes.append("a", PRIORITY_BULK, keys=["a"])
+    lanes.append("b", PRIORITY_DEFAULT, keys=["a", "b"])
+    assert lanes.last_lane(["a"]) == PRIORITY_BULK
+    assert lanes.last_lane(["b"]) == PRIORITY_DEFAULT
+    assert lanes.last_lane(["b"], PRIORITY_DEFAULT) is None
+    assert lanes.pop_matching(PRIORITY_BULK, lambda item: item == "a") == "a"
+    assert lanes.last_lane(["a"]) == PRIORITY_DEFAULT
+    lanes.get(0)
+    assert lanes.last_lane(["a", "b"]) is None
+    assert len(lanes.index) == 0
+
+
+class TextIU(retico_core.IncrementalUnit):
+    def __init__(self, text=None, **kwargs):
+        super().__init__(**kwargs)
+        self.text = text
+
+
+def update_message(iu, update_type):
+    um = retico_core.UpdateMessage()
+    um.add_iu(
+        AMQIU(
+            creator=iu.creator,
+            decorated_iu=iu,
+            headers={},
+            destination="/topic/test",
+        ),
+        update_type,
+    )
+    return um
+
+
+def test_writer_revoke_after_add():
+    writer = AMQWriter(ip="localhost", port=61613)
+    source = retico_core.AbstractModule()
+    first = TextIU(creator=source, iuid="s:1", text="a")
+    second = TextIU(creator=source, iuid="s:2", text="b")
+    writer.process_update(update_message(first, retico_core.UpdateType.ADD))
+    writer.process_update(update_message(first, retico_core.UpdateType.REVOKE))
+    writer.process_update(update_message(second, retico_core.UpdateType.REVOKE))
+    sent = [writer.queue.get(0)[2] for _ in range(3)]
+    # the REVOKEs are sent in the control lane, except behind the waiting ADD of their IU
+    assert [(h["update_type"], h["amq-iuid"]) for h in sent] == [
+        ("revoke", "s:2"),
+        ("add", "s:1"),
+        ("revoke", "s:1"),
+    ]
+
+
+def test_reader_revoke_after_add():
+    reader = AMQReader(ip="localhost", port=61613)
+
+    def frame(update_type, iuid, priority, producer="a"):
+        headers = {
+            "destination": "/topic/test",
+            "amq-producer": producer,
+            "update_type": update_type,
+            "amq-iuid": iuid,
+            "priority": priority,
+        }
+        return Frame("MESSAGE", headers, "{}")
+
+    reader.on_message(frame("add", "s:1", "0"))
+    reader.on_message(frame("revoke", "s:1", "9"))
+    # a message of another stream is not kept behind the moved back REVOKE
+    reader.on_message(frame("revoke", "s:2", "9", producer="b"))
+    received = [reader.queue.get(0).headers for _ in range(3)]
+    assert [(h["update_type"], h["amq-iuid"]) for h in received] == [
+        ("revoke", "s:2"),
+        ("add", "s:1"),
+        ("revoke", "s:1"),
+    ]
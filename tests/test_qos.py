@@ -0,0 +1,44 @@
+import time
+
+import pytest
+from stomp.utils import Frame
+
+from retico_amq.amq import QOS_PROFILES, QoSProfile, get_qos_profile, is_expired
+
+
+def test_qos_headers():
+    assert QoSProfile().headers() == {"persistent": "true"}
+    headers = QoSProfile(persistent=False, ttl=2.0).headers()
+    assert headers["persistent"] == "false"
+    # the STOMP `expires` header is an absolute time in milliseconds
+    assert abs(int(headers["expires"]) - (time.time() + 2.0) * 1000) < 100
+
+
+def test_get_qos_profile():
+    profile = QoSProfile(ttl=1.0)
+    assert get_qos_profile(profile) is profile
+    assert get_qos_profile("realtime") is QOS_PROFILES["realtime"]
+    assert get_qos_profile(None) is None
+    with pytest.raises(ValueError):
+        get_qos_profile("unknown")
+
+
+def frame(**headers):
+    return Frame("MESSAGE", {"destination": "/topic/test", **headers}, "")
+
+
+def test_is_expired():
+    now = int(time.time() * 1000)
+    assert not is_expired(frame())
+    assert is_expired(frame(expires=str(now - 1000)))
+    assert not is_expired(frame(expires=str(now + 60000)))
+    # 0 means that the message never expires
+    assert not is_expired(frame(expires="0"))
+    assert not is_expired(frame(expires="never"))
+
+
+def test_realtime_message_expires():
+    headers = QOS_PROFILES["realtime"].headers()
+    assert not is_expired(frame(**headers))
+    headers["expires"] = str(int(headers["expires"]) - 2000)
+    assert is_expired(frame(**headers))
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+from retico_amq.rate_limit import RateLimiter
+
+
+def iu(turn, iuid=None):
+    return SimpleNamespace(turnID=turn, iuid=iuid)
+
+
+def messages(released):
+    return [message for message, _ in released]
+
+
+def test_token_bucket():
+    limiter = RateLimiter(rate=10, burst=2)
+    for i in range(4):
+        limiter.offer(i, 0, iu(i))
+    assert messages(limiter.release()) == [0, 1]
+    assert limiter.release() == []
+    assert 0 < limiter.next_release() <= 0.1
+    # 0.1 second later, one token was refilled
+    limiter.last -= 0.1
+    assert messages(limiter.release()) == [2]
+    assert len(limiter) == 1
+
+
+def test_next_release_empty():
+    assert RateLimiter(rate=10).next_release() is None
+
+
+def test_max_pending():
+    limiter = RateLimiter(rate=10, burst=0, max_pending=2)
+    for i in range(3):
+        limiter.offer(i, 0, iu(i))
+    assert [message for message, _, _, _ in limiter.pending.values()] == [1, 2]
+    assert limiter.nb_dropped == 1
+
+
+def test_conflation():
+    limiter = RateLimiter(rate=10, burst=10, conflate="turnID")
+    first, second, other = iu(1), iu(1), iu(2)
+    limiter.offer("add 1", 1, first)
+    limiter.offer("add 2", 1, other)
+    limiter.offer("commit 1", 0, first, conflatable=False)
+    limiter.offer("add 1 newer", 1, second)
+    # the newest ADD keeps the position of the replaced ADD, whose other updates are dropped
+    assert messages(limiter.release()) == ["add 1 newer", "add 2"]
+    assert limiter.nb_conflated == 2
+
+
+def test_conflation_drops_later_updates():
+    limiter = RateLimiter(rate=10, burst=0, conflate="turnID")
+    first, second = iu(1, "a"), iu(1, "b")
+    limiter.offer("add a", 1, first)
+    limiter.offer("add b", 1, second)
+    # the replaced IU was never sent, neither are its updates arriving afterwards
+    limiter.offer("commit a", 1, first, conflatable=False)
+    limiter.offer("revoke a", 1, first, conflatable=False)
+    limiter.offer("commit b", 1, second, conflatable=False)
+    assert [message for message, _, _, _ in limiter.pending.values()] == [
+        "add b",
+        "commit b",
+    ]
+    assert limiter.nb_conflated == 3
+
+
+def test_replaced_iuids_bounded():
+    limiter = RateLimiter(rate=10, burst=0, conflate="turnID", max_replaced=1)
+    limiter.offer("add a", 1, iu(1, "a"))
+    limiter.offer("add b", 1, iu(1, "b"))
+    limiter.offer("add c", 1, iu(1, "c"))
+    assert list(limiter.replaced_iuids) == ["b"]
+
+
+def test_no_conflation_without_key():
+    limiter = RateLimiter(rate=10, burst=10, conflate="turnID")
+    limiter.offer("add a", 1, iu(None, "a"))
+    limiter.offer("add b", 1, iu(None, "b"))
+    limiter.offer("envelope", 1, None, conflatable=False)
+    assert messages(limiter.release()) == ["add a", "add b", "envelope"]
+    assert limiter.nb_conflated == 0
+
+
+def test_no_conflation_of_updates():
+    limiter = RateLimiter(rate=10, burst=10, conflate="turnID")
+    add = iu(1)
+    limiter.offer("add", 1, add)
+    limiter.offer("revoke", 1, add, conflatable=False)
+    limiter.offer("commit", 1, add, conflatable=False)
+    assert messages(limiter.release()) == ["add", "revoke", "commit"]
+    assert limiter.nb_conflated == 0
+
+
+def test_last_lane():
+    limiter = RateLimiter(rate=10, burst=1, conflate="turnID")
+    limiter.offer("a", 0, iu(1, "a"), keys=["a"])
+    limiter.offer("b", 2, iu(2, "b"), keys=["b"])
+    limiter.offer("c", 1, iu(3, "c"), keys=["c", "b"])
+    assert limiter.last_lane(["a", "b", "c"]) == 2
+    assert limiter.last_lane(["c"]) == 1
+    assert limiter.last_lane(["b"], lane=2) is None
+    # the keys of the released, conflated and dropped messages are forgotten
+    limiter.release()
+    assert limiter.last_lane(["a"]) is None
+    limiter.offer("b newer", 0, iu(2, "b2"), keys=["b2"])
+    assert limiter.last_lane(["b"]) == 1
+    limiter.max_pending = 2
+    limiter.offer("d", 0, iu(None, "d"), keys=["d"])
+    # "b newer" took the place of "b", before "c"
+    assert limiter.last_lane(["b2"], lane=-1) is None
+    assert len(limiter.index) == 3
@@ -0,0 +1,28 @@
+from retico_amq.amq import DestinationRouter
+
+
+def test_router_precedence():
+    router = DestinationRouter()
+    router.add("/topic/agent.>", ">")
+    router.add("/topic/agent.*.ASR", "*")
+    router.add("/topic/agent.1.ASR", "literal")
+    router.add("/queue/agent.1.ASR", "queue")
+    assert router.resolve("/topic/agent.1.ASR") == "literal"
+    assert router.resolve("/topic/agent.2.ASR") == "*"
+    assert router.resolve("/topic/agent.2.TTS") == ">"
+    assert router.resolve("/topic/agent.2.ASR.x") == ">"
+    assert router.resolve("/queue/agent.1.ASR") == "queue"
+    # `>` matches at least one element, and never the prefix
+    assert router.resolve("/topic/agent") is None
+    assert router.resolve("/queue/agent.2.ASR") is None
+
+
+def test_router_cache():
+    router = DestinationRouter(cache_size=1)
+    router.add("/topic/a.*", "*")
+    assert router.resolve("/topic/a.b") == "*"
+    assert router.resolve("/topic/a.c") == "*"
+    assert len(router.cache) == 1
+    # a new pattern invalidates the cached resolutions
+    router.add("/topic/a.c", "literal")
+    assert router.resolve("/topic/a.c") == "literal"
@@ -0,0 +1,112 @@
+import time
+
+from stomp.utils import Frame
+
+from retico_amq.amq import SequenceTracker
+
+
+def message(seq=None, group=None, producer="p", message_id=None, stream=None):
+    headers = {"destination": "/topic/test", "amq-producer": producer}
+    if seq is not None:
+        headers["amq-seq"] = str(seq)
+    if group is not None:
+        headers["JMSXGroupID"] = group
+    if message_id is not None:
+        headers["message-id"] = message_id
+    if stream is not None:
+        headers["amq-stream"] = stream
+    return Frame("MESSAGE", headers, "")
+
+
+def seqs(frames):
+    return [int(frame.headers["amq-seq"]) for frame in frames]
+
+
+def test_sequence_first_seen():
+    tracker = SequenceTracker()
+    # a stream starts at the first sequence number received, e.g. after the reader joined late
+    assert seqs(tracker.push(message(5))) == [5]
+    assert seqs(tracker.push(message(6))) == [6]
+    assert tracker.stats()["gaps"] == 0
+
+
+def test_sequence_reorder():
+    tracker = SequenceTracker()
+    assert seqs(tracker.push(message(0))) == [0]
+    assert tracker.push(message(2)) == []
+    assert tracker.push(message(3)) == []
+    assert seqs(tracker.push(message(1))) == [1, 2, 3]
+    assert tracker.stats() == {"duplicates": 0, "reordered": 2, "gaps": 0, "pending": 0}
+    assert tracker.pending == {}
+
+
+def test_sequence_gap_timeout():
+    tracker = SequenceTracker(reorder_timeout=0.01)
+    tracker.push(message(0))
+    assert tracker.push(message(3)) == []
+    assert tracker.flush() == []
+    time.sleep(0.02)
+    assert seqs(tracker.flush()) == [3]
+    assert tracker.stats()["gaps"] == 2
+    assert seqs(tracker.push(message(4))) == [4]
+
+
+def test_sequence_gap_full_buffer():
+    tracker = SequenceTracker(reorder_size=2)
+    tracker.push(message(0))
+    assert tracker.push(message(2)) == []
+    assert tracker.push(message(3)) == []
+    assert seqs(tracker.push(message(4))) == [2, 3, 4]
+    assert tracker.stats()["gaps"] == 1
+
+
+def test_sequence_dedup():
+    tracker = SequenceTracker()
+    tracker.push(message(0))
+    tracker.push(message(2))
+    assert tracker.push(message(0)) == []
+    assert tracker.push(message(2)) == []
+    assert tracker.stats()["duplicates"] == 2
+
+
+def test_sequence_dedup_unsequenced():
+    tracker = SequenceTracker(dedup_window=2)
+    assert len(tracker.push(message(message_id="a"))) == 1
+    assert tracker.push(message(message_id="a")) == []
+    tracker.push(message(message_id="b"))
+    tracker.push(message(message_id="c"))
+    # "a" left the dedup window
+    assert len(tracker.push(message(message_id="a"))) == 1
+
+
+def test_sequence_streams():
+    tracker = SequenceTracker()
+    tracker.push(message(0, group="a"))
+    assert seqs(tracker.push(message(0, group="b"))) == [0]
+    assert seqs(tracker.push(message(0, producer="q"))) == [0]
+    # a stream restarted by the writer under a new stream id
+    assert seqs(tracker.push(message(0, group="a", stream="1"))) == [0]
+
+
+def test_sequence_grouped_only():
+    tracker = SequenceTracker(grouped_only=True)
+    tracker.push(message(0))
+    # a competing consumer only receives part of the ungrouped messages
+    assert seqs(tracker.push(message(5))) == [5]
+    tracker.push(message(0, group="a"))
+    assert tracker.push(message(2, group="a")) == []
+
+
+def test_sequence_eviction():
+    tracker = SequenceTracker(max_streams=2)
+    tracker.push(message(0, group="a"))
+    tracker.push(message(0, group="b"))
+    assert tracker.push(message(2, group="a")) == []
+    # "b" is the least recently used stream
+    tracker.push(message(0, group="c"))
+    assert [stream[3] for stream in tracker.expected] == ["a", "c"]
+    # "a" is evicted, its waiting message is delivered
+    assert seqs(tracker.push(message(0, group="d"))) == [2, 0]
+    assert [stream[3] for stream in tracker.expected] == ["c", "d"]
+    assert tracker.pending == {}
+    assert tracker.stats()["gaps"] == 1
@@ -0,0 +1,91 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from stomp.utils import Frame
+
+from retico_amq.amq import AMQReader
+from retico_amq.shm import SLOT_HEADER, SharedMemoryRing
+
+
+@pytest.fixture
+def ring():
+    ring = SharedMemoryRing(size=100, retention=60.0)
+    yield ring
+    ring.close()
+
+
+def test_allocate_empty(ring):
+    assert ring._allocate(100) == 0
+    assert ring._allocate(101) is None
+
+
+def test_allocate_contiguous(ring):
+    now = time.monotonic()
+    ring.slots = deque([(40, 60, now), (60, 90, now)])
+    assert ring._allocate(10) == 90
+    # wraps to the beginning of the segment, before the first used slot
+    assert ring._allocate(30) == 0
+    assert ring._allocate(41) is None
+
+
+def test_allocate_wrapped(ring):
+    now = time.monotonic()
+    ring.slots = deque([(60, 90, now), (0, 20, now)])
+    assert ring._allocate(40) == 20
+    assert ring._allocate(41) is None
+
+
+def test_allocate_reclaims_expired_slots(ring):
+    now = time.monotonic()
+    ring.slots = deque([(0, 50, now - 120), (50, 90, now)])
+    assert ring._allocate(50) == 0
+    assert len(ring.slots) == 1
+
+
+def test_write_read_wrap_around(ring):
+    data = b"x" * (40 - SLOT_HEADER.size)
+    first = ring.write(data)
+    second = ring.write(data)
+    # no free slot until the first one expires
+    assert ring.write(data) is None
+    ring.slots[0] = ring.slots[0][:2] + (time.monotonic() - 120,)
+    third = ring.write(b"y" * len(data))
+    offset, length, generation = (int(x) for x in third.rsplit(":", 3)[1:])
+    assert offset == 0
+    assert bytes(ring.read(offset, length, generation)) == b"y" * len(data)
+    # the first slot was overwritten, the second one is still valid
+    for handle, valid in ((first, False), (second, True)):
+        offset, length, generation = (int(x) for x in handle.rsplit(":", 3)[1:])
+        assert ring.is_valid(offset, length, generation) == valid
+
+
+def test_shm_body_decoded_by_pool():
+    ring = SharedMemoryRing(size=4096)
+    reader = AMQReader(ip="localhost", port=61613, decode_threshold=100)
+    reader.add("/topic/test", object)
+    reader.decode_pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        body = '{"data": "%s"}' % ("x" * 200)
+        handle = ring.write(body.encode())
+        headers = {"destination": "/topic/test", "amq-shm": handle}
+        # the frame's body is empty, the size comes from the handle
+        decoded = reader.submit_decode(Frame("MESSAGE", headers, ""))
+        assert decoded.result() == {"data": "x" * 200}
+        small = ring.write(b"{}")
+        assert (
+            reader.submit_decode(Frame("MESSAGE", {**headers, "amq-shm": small}, ""))
+            is None
+        )
+        # a lost body fails its future, the message is dropped when it is processed
+        lost = handle.rsplit(":", 1)[0] + ":0"
+        decoded = reader.submit_decode(
+            Frame("MESSAGE", {**headers, "amq-shm": lost}, "")
+        )
+        with pytest.raises(ValueError):
+            decoded.result()
+    finally:
+        reader.decode_pool.shutdown()
+        reader.shm_reader.close()
+        ring.close()
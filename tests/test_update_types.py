@@ -0,0 +1,100 @@
+import json
+
+import retico_core
+from stomp.utils import Frame
+
+from retico_amq.amq import UPDATE_TYPES, AMQReader
+
+
+class TextIU(retico_core.IncrementalUnit):
+    def __init__(self, text=None, **kwargs):
+        super().__init__(**kwargs)
+        self.text = text
+
+
+def test_update_types():
+    for ut in retico_core.UpdateType:
+        assert UPDATE_TYPES[ut.value] is ut
+        # the values sent by the older writers
+        assert UPDATE_TYPES[f"UpdateType.{ut.name}"] is ut
+    assert "unknown" not in UPDATE_TYPES
+
+
+def frame(update_type, text=None, iuid="s:1", **headers):
+    headers = {
+        "destination": "/topic/test",
+        "update_type": update_type,
+        "amq-iuid": iuid,
+        **headers,
+    }
+    body = "not json" if text is None else json.dumps({"requestID": iuid, "text": text})
+    return Frame("MESSAGE", headers, body)
+
+
+def reader_and_output():
+    reader = AMQReader(ip="localhost", port=61613)
+    reader.add("/topic/test", TextIU)
+    received = []
+    reader.append = lambda update_message: received.extend(update_message)
+    return reader, received
+
+
+def test_is_header_only():
+    assert AMQReader.is_header_only(frame("revoke"))
+    assert AMQReader.is_header_only(frame("commit"))
+    # an UPDATE carries the new body of the IU
+    assert not AMQReader.is_header_only(frame("update"))
+    assert not AMQReader.is_header_only(frame("add"))
+    assert not AMQReader.is_header_only(
+        Frame("MESSAGE", {"destination": "/topic/test", "update_type": "revoke"}, "")
+    )
+
+
+def test_header_only_revoke():
+    reader, received = reader_and_output()
+    reader.process_frame(frame("add", "a"))
+    # the body of a REVOKE of an indexed IU is not decoded
+    reader.process_frame(frame("revoke"))
+    (added, add), (revoked, revoke) = received
+    assert revoked is added
+    assert revoke == retico_core.UpdateType.REVOKE
+    assert (
+        reader.metrics.snapshot()[
+            'amq_header_only_updates_total{destination="/topic/test"}'
+        ]
+        == 1
+    )
+
+
+def test_update_decodes_body():
+    reader, received = reader_and_output()
+    reader.process_frame(frame("add", "old"))
+    reader.process_frame(frame("update", "new"))
+    reader.process_frame(frame("commit"))
+    (_, _), (updated, update), (committed, _) = received
+    assert updated.text == "new"
+    assert update == retico_core.UpdateType.UPDATE
+    # the IU index now resolves the iuid to the updated IU
+    assert committed is updated
+
+
+def test_envelope_header_only_entries():
+    reader, received = reader_and_output()
+    reader.process_frame(frame("add", "a"))
+    envelope = {
+        "envelope": [
+            {"update_type": "commit", "iu": {"requestID": "s:1", "text": "a"}},
+            {"update_type": "revoke", "iu": {"requestID": "s:2", "text": "b"}},
+        ]
+    }
+    reader.process_frame(
+        Frame(
+            "MESSAGE",
+            {"destination": "/topic/test", "amq-envelope": "1", "amq-iuid": "s:1,s:2"},
+            json.dumps(envelope),
+        )
+    )
+    (added, _), (committed, _), (revoked, _) = received
+    assert committed is added
+    # an IU that is not indexed is created from the entry
+    assert revoked.text == "b"